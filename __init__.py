@@ -1,5 +1,4 @@
 import sys
-from smorgasbord import ops
 
 
 bl_info = {
@@ -22,11 +21,16 @@ def _flush_modules(pkg_name):
             del sys.modules[k]
 
 
+# Operators are only imported on registration, as processes of
+# smorgasbord.common.parallel import this package, too, and must not
+# load them
 def register():
+    from smorgasbord import ops
     ops.register()
 
 
 def unregister():
+    from smorgasbord import ops
     ops.unregister()
     _flush_modules("smorgasbord")
 
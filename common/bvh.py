@@ -0,0 +1,169 @@
+import numpy as np
+
+from smorgasbord.common.kdtree import BatchKDTree
+
+
+def _dot(u, v):
+    return np.einsum('...i,...i->...', u, v)
+
+
+def closest_pts_on_tris(pts, a, b, c):
+    """
+    Find the closest point on each triangle to the corresponding
+    point. All arguments broadcast against each other.
+
+    Follows the Voronoi region test from Ericson's Real-Time Collision
+    Detection, 5.1.5, evaluated for all regions at once.
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        ...x3 array of query points
+    a, b, c : numpy.ndarray
+        ...x3 arrays with the corners of each triangle
+
+    Returns
+    -------
+    closest : numpy.ndarray
+        ...x3 array of the closest point on each triangle
+
+    Examples
+    --------
+    A collapsed triangle is a segment, even if its first two corners
+    coincide
+
+    >>> closest_pts_on_tris(
+    ...     np.array([[1., 1, 0], [3, 1, 0]]),
+    ...     np.zeros(3), np.zeros(3), np.array([2., 0, 0]))
+    array([[1., 0., 0.],
+           [2., 0., 0.]])
+    """
+    ab = b - a
+    ac = c - a
+    ap = pts - a
+    bp = pts - b
+    cp = pts - c
+    d1 = _dot(ab, ap)
+    d2 = _dot(ac, ap)
+    d3 = _dot(ab, bp)
+    d4 = _dot(ac, bp)
+    d5 = _dot(ab, cp)
+    d6 = _dot(ac, cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    # Squared edge lengths
+    len_ab = d1 - d3
+    len_ac = d2 - d6
+    len_bc = (d4 - d3) + (d5 - d6)
+
+    # Barycentric weights of b and c for every region the point may be
+    # closest to. Divisions by zero only happen in regions that aren't
+    # chosen, or for zero-length edges, which are never chosen.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_ab = np.where(len_ab > 0, d1 / len_ab, 0)
+        t_ac = np.where(len_ac > 0, d2 / len_ac, 0)
+        t_bc = np.where(len_bc > 0, (d4 - d3) / len_bc, 0)
+        denom = va + vb + vc
+        v_in = np.where(denom != 0, vb / denom, 0)
+        w_in = np.where(denom != 0, vc / denom, 0)
+
+    # A zero-length edge has degenerate tests that would shadow the
+    # remaining segment's region, so it is skipped
+    regions = (
+        (d1 <= 0) & (d2 <= 0),                             # vertex a
+        (d3 >= 0) & (d4 <= d3),                            # vertex b
+        (vc <= 0) & (d1 >= 0) & (d3 <= 0) & (len_ab > 0),  # edge ab
+        (d6 >= 0) & (d5 <= d6),                            # vertex c
+        (vb <= 0) & (d2 >= 0) & (d6 <= 0) & (len_ac > 0),  # edge ac
+        (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+        & (len_bc > 0),                                    # edge bc
+        )
+    v = np.select(regions, (0, 1, t_ab, 0, 0, 1 - t_bc), v_in)
+    w = np.select(regions, (0, 0, 0, 1, t_ac, t_bc), w_in)
+    return a + v[..., np.newaxis] * ab + w[..., np.newaxis] * ac
+
+
+class TriangleBVH(BatchKDTree):
+    """
+    A bounding volume hierarchy over triangles, answering batches of
+    closest-point queries.
+
+    Triangles are split like the points of a BatchKDTree, by their
+    centroids, while each node's box encloses its triangles entirely.
+    Takes the flat vertex and triangle index arrays returned by
+    combine_meshes().
+    """
+
+    # Triangles may reach across the plane their centroids are split at
+    _split_separates = False
+
+    def __init__(self, verts, tris, leafsize=8):
+        """
+        Parameters
+        ----------
+        verts : numpy.ndarray
+            Nx3 array of vertex coordinates
+        tris : numpy.ndarray
+            Mx3 int array of vertex indices of each triangle
+        leafsize : int = 8
+            Maximum number of triangles per leaf
+        """
+        self.verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+        self.tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+        super().__init__(self.verts[self.tris].mean(axis=1), leafsize)
+
+    def _prim_bounds(self):
+        corners = self.verts[self.tris]
+        return corners.min(axis=1), corners.max(axis=1)
+
+    def _init_leaves(self):
+        # Copy the corners of the triangles in each leaf into one
+        # contiguous block
+        self._leafcorners = np.append(
+            self.verts[self.tris], np.zeros((1, 3, 3)), axis=0,
+            )[self.leaves]
+
+    def _leaf_dists_sq(self, pts, leaves):
+        pts = pts[:, np.newaxis]
+        corners = self._leafcorners[leaves]
+        d = closest_pts_on_tris(
+            pts, corners[:, :, 0], corners[:, :, 1], corners[:, :, 2],
+            ) - pts
+        return np.einsum('ijk,ijk->ij', d, d)
+
+    def find_closest(self, pts, maxdist=np.inf, chunksize=2**12):
+        """
+        Project each of the given points onto the closest triangle.
+
+        Parameters
+        ----------
+        pts : numpy.ndarray
+            Mx3 array of query points
+        maxdist : float = inf
+            Triangles farther away from a query point are ignored.
+        chunksize : int
+            Number of query points processed at once. Bounds memory
+            consumption.
+
+        Returns
+        -------
+        indcs : numpy.ndarray
+            Index of the closest triangle for every query point, -1 if
+            none lies within 'maxdist'.
+        closest : numpy.ndarray
+            Mx3 array of the closest point on that triangle, NaN if
+            none lies within 'maxdist'.
+        dists : numpy.ndarray
+            Distance to the closest point for every query point,
+            infinity if none lies within 'maxdist'.
+        """
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 3)
+        indcs, dists = self.query(pts, maxdist, chunksize)
+        closest = np.full_like(pts, np.nan)
+        found = indcs >= 0
+        corners = self.verts[self.tris[indcs[found]]]
+        closest[found] = closest_pts_on_tris(
+            pts[found], corners[:, 0], corners[:, 1], corners[:, 2])
+        return indcs, closest, dists
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from hashlib import blake2b
+import os
+
+import numpy as np
+
+from smorgasbord.common.io import get_vecs
+
+
+def make_key(*parts):
+    """
+    Combine arbitrary values into one short string key. Arrays are
+    hashed by their raw buffer, everything else by its repr().
+
+    Examples
+    --------
+    >>> make_key('Cube', 8, 512) == make_key('Cube', 8, 512)
+    True
+    """
+    h = blake2b(digest_size=16)
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            h.update(np.ascontiguousarray(p).tobytes())
+        else:
+            h.update(repr(p).encode())
+        # Separate parts so ('ab', 'c') and ('a', 'bc') differ
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def mesh_fingerprint(mesh):
+    """
+    Return a cheap fingerprint of a mesh's geometry, which changes
+    whenever a vertex is added, removed, or moved.
+
+    Parameters
+    ----------
+    mesh : bpy.types.Mesh
+        Mesh to fingerprint
+
+    Returns
+    -------
+    fingerprint : tuple
+        The mesh's full name, its vertex and polygon count, and a hash
+        of its vertex coordinates
+    """
+    co = get_vecs(mesh.vertices, dtype=np.float32)
+    return (
+        mesh.name_full,
+        len(mesh.vertices),
+        len(mesh.polygons),
+        blake2b(co.tobytes(), digest_size=16).hexdigest(),
+        )
+
+
+class DescriptorCache:
+    """
+    A least-recently-used cache of shape descriptors, i.e. of numpy
+    arrays stored by string keys as returned by make_key(). Optionally
+    persisted to an .npz file.
+    """
+
+    def __init__(self, maxsize=2**16, maxbytes=None):
+        """
+        Parameters
+        ----------
+        maxsize : int = 2**16
+            Number of descriptors kept before the least recently used
+            one is evicted
+        maxbytes : int or None = None
+            Total size of the descriptors in bytes past which the least
+            recently used ones are evicted, unbounded if None
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # Path of the last file loaded, to not load it twice
+        self._loaded = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return the descriptor stored by 'key' and mark it as recently
+        used. Returns None if there is none.
+        """
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:
+            return None
+        return self._entries[key]
+
+    def put(self, key, val):
+        """
+        Store a descriptor by 'key', evicting the least recently used
+        ones if the cache is full.
+        """
+        val = np.asarray(val)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._nbytes -= old.nbytes
+        self._entries[key] = val
+        self._nbytes += val.nbytes
+        while len(self._entries) > self.maxsize or (
+                self.maxbytes is not None
+                and self._nbytes > self.maxbytes):
+            self._nbytes -= self._entries.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+        self._loaded = None
+
+    def load(self, path):
+        """
+        Add the descriptors stored in an .npz file to the cache.
+        Missing or unreadable files are ignored, as the cache can
+        always be rebuilt. Each file is only loaded once.
+        """
+        if path == self._loaded:
+            return
+        self._loaded = path
+        try:
+            with np.load(path) as f:
+                for key in f.files:
+                    if key not in self._entries:
+                        self.put(key, f[key])
+        except (OSError, ValueError):
+            pass
+
+    def save(self, path):
+        """
+        Write all descriptors in the cache to an .npz file.
+        """
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **self._entries)
+        # Don't leave a half-written file behind if Blender is killed
+        os.replace(tmp, path)
+        self._loaded = path
+
+
+def sidecar_path(blendpath, suffix='_shapes.npz'):
+    """
+    Return the path of the cache file next to a .blend file, or None
+    if the file isn't saved yet.
+    """
+    if not blendpath:
+        return None
+    return os.path.splitext(blendpath)[0] + suffix
@@ -0,0 +1,215 @@
+import numpy as np
+
+from smorgasbord.common.sample import (
+    get_shape_distrib,
+    sample_tris,
+    scale_to_paircnt,
+)
+
+
+# Descriptors computed from random samples, which depend on the sample
+# count, bin count and seed
+SAMPLED = ('D2', 'A3')
+
+
+def get_a3_distrib(points, bincnt=32, tripcnt=None, seed=None):
+    """
+    Calculate the histogram of the angles spanned by random triplets
+    of distinct points, as fraction of all triplets drawn.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Nx3 array of at least three points
+    bincnt : int = 32
+        Number of bins the angles between zero and pi are sorted into
+    tripcnt : int or None = None
+        Number of triplets to draw, N * 'bincnt' if None
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw triplets with
+
+    Returns
+    -------
+    hist : numpy.ndarray
+        Fraction of triplets in each bin
+    bins : numpy.ndarray
+        Bin edges, as returned by numpy.histogram()
+    """
+    points = np.asanyarray(points)
+    n = len(points)
+    if n < 3:
+        return np.zeros(bincnt), np.linspace(0, np.pi, bincnt + 1)
+
+    # Draw three distinct indices per triplet by shifting the later
+    # ones past the ones drawn before
+    rng = np.random.default_rng(seed)
+    tripcnt = tripcnt or n * bincnt
+    i = rng.integers(0, n, tripcnt)
+    j = rng.integers(0, n - 1, tripcnt)
+    j[j >= i] += 1
+    k = rng.integers(0, n - 2, tripcnt)
+    lo = np.minimum(i, j)
+    k[k >= lo] += 1
+    k[k >= np.maximum(i, j)] += 1
+
+    # Angle at the middle point. arctan2 stays defined for
+    # coinciding points.
+    u = points[i] - points[j]
+    v = points[k] - points[j]
+    angles = np.arctan2(
+        np.linalg.norm(np.cross(u, v), axis=1),
+        np.einsum('ij,ij->i', u, v),
+        )
+    hist, bins = np.histogram(angles, bins=bincnt, range=(0, np.pi))
+    return hist / tripcnt, bins
+
+
+def get_surface_moments(pts, tris):
+    """
+    Return the area, centroid, and covariance matrix of a triangle
+    mesh's surface, integrated exactly over every triangle.
+
+    Parameters
+    ----------
+    pts : numpy.ndarray
+        Nx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
+
+    Returns
+    -------
+    area : float
+        Surface area
+    centr : numpy.ndarray
+        Area-weighted centroid
+    cov : numpy.ndarray
+        3x3 covariance matrix of the points on the surface
+    """
+    corners = np.asanyarray(pts, dtype=np.float64)[tris]
+    areas = .5 * np.linalg.norm(np.cross(
+        corners[:, 1] - corners[:, 0],
+        corners[:, 2] - corners[:, 0],
+        ), axis=1)
+    area = areas.sum()
+    if area == 0:
+        return 0., np.zeros(3), np.zeros((3, 3))
+
+    centr = areas @ corners.mean(axis=1) / area
+    # Center first so the sums don't lose precision far from the origin
+    corners = corners - centr
+    csum = corners.sum(axis=1)
+    # For a triangle with corners v_i and area A, the integral of x x^T
+    # over it is A / 12 * (sum of v_i v_i^T + (sum v_i)(sum v_i)^T)
+    wcorners = (corners * areas[:, np.newaxis, np.newaxis]).reshape(-1, 3)
+    cov = wcorners.T @ corners.reshape(-1, 3)
+    cov += (csum * areas[:, np.newaxis]).T @ csum
+    cov /= 12 * area
+    return area, centr, cov
+
+
+def get_moment_ratios(pts, tris):
+    """
+    Return the ratios of the second and third largest to the largest
+    principal moment of a mesh's surface. Both are one for a sphere
+    and close to zero for a line.
+    """
+    _, _, cov = get_surface_moments(pts, tris)
+    # Ascending
+    eigvals = np.linalg.eigvalsh(cov)
+    if eigvals[2] <= 0:
+        return np.zeros(2)
+    return np.clip(eigvals[1::-1] / eigvals[2], 0, 1)
+
+
+def get_box_ratios(pts, tris):
+    """
+    Return the ratios of the middle and shortest to the longest edge
+    of a mesh's bounding box aligned to its principal axes.
+    """
+    _, _, cov = get_surface_moments(pts, tris)
+    _, axes = np.linalg.eigh(cov)
+    # Vertices not part of any triangle don't count
+    used = np.zeros(len(pts), dtype=bool)
+    used[tris] = True
+    used = np.asanyarray(pts)[used]
+    exts = np.sort(np.ptp(used @ axes, axis=0))[::-1] \
+        if len(used) else np.zeros(3)
+    if exts[0] <= 0:
+        return np.zeros(2)
+    return exts[1:] / exts[0]
+
+
+def get_compactness(pts, tris):
+    """
+    Return how close a closed mesh comes to a sphere: 36 pi V^2 / A^3,
+    with V its volume and A its surface area. One for a sphere, less
+    for everything else.
+    """
+    corners = np.asanyarray(pts, dtype=np.float64)[tris]
+    if not len(corners):
+        return np.zeros(1)
+    # Any origin gives the same volume for a closed mesh. One inside
+    # the mesh keeps precision.
+    corners -= corners.reshape(-1, 3).mean(axis=0)
+    # Sum of signed volumes of the tetrahedra spanned by the origin and
+    # every triangle
+    vol = abs(np.einsum(
+        'ij,ij->',
+        corners[:, 0],
+        np.cross(corners[:, 1], corners[:, 2]),
+        )) / 6
+    area = .5 * np.linalg.norm(np.cross(
+        corners[:, 1] - corners[:, 0],
+        corners[:, 2] - corners[:, 0],
+        ), axis=1).sum()
+    if area == 0:
+        return np.zeros(1)
+    return np.array([min(1., 36 * np.pi * vol ** 2 / area ** 3)])
+
+
+def get_descriptor(kind, pts, tris, samplecnt=512, bincnt=23,
+                   maxpairs=None, seed=None):
+    """
+    Compute a rotation- and scale-invariant shape descriptor of a
+    triangle mesh.
+
+    Parameters
+    ----------
+    kind : str
+        Which descriptor to compute:
+        'D2': histogram of distances between pairs of surface samples,
+        scaled up to all pairs
+        'A3': histogram of angles between triplets of surface samples
+        'MOMENTS': principal moment ratios, see get_moment_ratios()
+        'BOX': principal bounding box ratios, see get_box_ratios()
+        'COMPACTNESS': see get_compactness()
+    pts : numpy.ndarray
+        Nx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
+    samplecnt, bincnt, maxpairs, seed
+        Sample and bin count for sampled descriptors, the number of
+        pairs or triplets drawn from the samples, and the seed to draw
+        them with
+
+    Returns
+    -------
+    desc : numpy.ndarray
+        One-dimensional descriptor
+    """
+    if kind in SAMPLED:
+        rng = np.random.default_rng(seed)
+        points = sample_tris(pts, tris, samplecnt, rng)
+        if kind == 'D2':
+            # Draw pairs from where the samples left off, not from a
+            # stream seeded alike, which would correlate both
+            hist, _ = get_shape_distrib(points, bincnt, maxpairs, rng)
+            return scale_to_paircnt(hist, len(points))
+        return get_a3_distrib(points, bincnt, maxpairs, rng)[0]
+    if kind == 'MOMENTS':
+        return get_moment_ratios(pts, tris)
+    if kind == 'BOX':
+        return get_box_ratios(pts, tris)
+    if kind == 'COMPACTNESS':
+        return get_compactness(pts, tris)
+    raise ValueError(f"Unknown descriptor '{kind}'")
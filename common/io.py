@@ -94,7 +94,121 @@ def get_bounds_and_center(points):
     return bounds, center
 
 
-def get_parts(verts):
+def get_part_bounds_and_centers(points, labels):
+    """
+    Calculate the bounds and center of every part of a labeled point
+    set at once. This is the segmented version of
+    get_bounds_and_center() and avoids one call per part.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        NxD array of points to calculate the bounds and centers of.
+    labels : numpy.ndarray
+        Non-negative int array of length N holding the part each point
+        belongs to.
+
+    Returns
+    -------
+    co_min : numpy.ndarray
+        PxD array with the minimal coordinates of each of the P parts,
+        where P is the largest label + 1. Rows of labels without any
+        point are NaN.
+    co_max : numpy.ndarray
+        PxD array with the maximal coordinates of each part
+    bounds : numpy.ndarray
+        PxD array with the extents of each part's bounding volume
+    center : numpy.ndarray
+        PxD array with the center of each part's bounding volume
+    """
+    points = np.asanyarray(points)
+    labels = np.asanyarray(labels)
+    counts = np.bincount(labels)
+    co_min = np.full((len(counts), points.shape[1]), np.nan)
+    co_max = co_min.copy()
+
+    if len(labels):
+        # Sort points by part so every part is a contiguous segment
+        # that can be reduced in one go
+        points = points[np.argsort(labels, kind='stable')]
+        # Start of each segment. Empty parts are skipped, because
+        # reduceat() would return a value for them anyway.
+        filled = counts > 0
+        starts = (np.cumsum(counts) - counts)[filled]
+        co_min[filled] = np.minimum.reduceat(points, starts, axis=0)
+        co_max[filled] = np.maximum.reduceat(points, starts, axis=0)
+
+    bounds = co_max - co_min
+    center = (co_max + co_min) * 0.5
+    return co_min, co_max, bounds, center
+
+
+def label_parts(edges, vertcnt):
+    """
+    Label connected components of a graph given as edge array. Two
+    vertices share a label if they are connected over an arbitrary
+    sequence of edges.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Nx2 int array of vertex index pairs, e.g. read from a mesh's
+        edges via get_vecs(mesh.edges, 'vertices', 2, np.int32)
+    vertcnt : int
+        Number of vertices in the graph. Vertices not referenced by any
+        edge form a part on their own.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Part label of each vertex. Labels run from 0 to the number of
+        parts - 1 and are ordered by the smallest vertex index of each
+        part.
+    indcs : numpy.ndarray
+        Vertex indices sorted by part. Together with 'offsets' this is
+        a CSR-style representation of the parts.
+    offsets : numpy.ndarray
+        Array of length part count + 1. The vertex indices of part i
+        are indcs[offsets[i]:offsets[i + 1]].
+    """
+    # Every vertex starts as the root of its own part
+    labels = np.arange(vertcnt)
+    edges = np.asarray(edges).reshape(-1, 2)
+    u, v = edges.T
+
+    while len(u):
+        lu = labels[u]
+        lv = labels[v]
+        # Drop edges already inside one part, so every iteration only
+        # touches edges between parts still to be merged
+        diff = lu != lv
+        u, v, lu, lv = u[diff], v[diff], lu[diff], lv[diff]
+        if not len(u):
+            break
+
+        # Hook the bigger root of each edge onto the smaller one. Roots
+        # only ever decrease, so no cycles can emerge.
+        np.minimum.at(labels, np.maximum(lu, lv), np.minimum(lu, lv))
+
+        # Pointer jumping: flatten every tree so each vertex points
+        # directly to its root again
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+    # Roots are the smallest vertex index of each part, so the
+    # consecutive relabeling keeps parts ordered by it
+    _, labels = np.unique(labels, return_inverse=True)
+    labels = labels.ravel()
+    indcs = np.argsort(labels, kind='stable')
+    offsets = np.zeros(labels.max(initial=-1) + 2, dtype=np.int64)
+    np.cumsum(np.bincount(labels), out=offsets[1:])
+    return labels, indcs, offsets
+
+
+def get_parts(geom):
     """
     Group vertex indices into disjunct parts so that no vertex in one
     part is connected to any vertex in another part over an arbitrary
@@ -102,39 +216,27 @@ def get_parts(verts):
 
     Parameters
     ----------
-    verts : bmesh.BMVertSequence
-        Bmesh vertex list to group into parts
+    geom : bpy.types.Mesh or bmesh.types.BMVertSequence
+        Mesh or bmesh vertex list to group into parts. Meshes are read
+        in bulk and are much faster.
 
     Returns
     -------
     parts : List[List[int]]
         List of parts. Each part in turn is a list of vertex indices.
     """
-    # Bool array of vertex indices already pushed on stack
-    flags = np.zeros(len(verts), dtype=bool)
-    verts.ensure_lookup_table()
-    parts = []
-
-    for i, visited in enumerate(flags):
-        if visited:
-            continue
-
-        flags[i] = True
-        # Vertex indices of one loose part
-        indcs = []
-
-        # Vertices to be traversed
-        stack = [verts[i]]
-        while stack:
-            v = stack.pop()
-            indcs.append(v.index)
-
-            # Push all vertices connected to v on stack
-            for e in v.link_edges:
-                v2 = e.other_vert(v)
-                # but only if not already checked
-                if not flags[v2.index]:
-                    flags[v2.index] = True
-                    stack.append(v2)
-        parts.append(indcs)
-    return parts
+    if hasattr(geom, 'edges'):
+        edges = get_vecs(geom.edges, 'vertices', 2, np.int32)
+        vertcnt = len(geom.vertices)
+    else:
+        # Bmesh sequences can't be read in bulk, so gather their edges
+        # one by one
+        geom.index_update()
+        edges = np.array([
+            (v.index, e.other_vert(v).index)
+            for v in geom for e in v.link_edges
+            ], dtype=np.int32)
+        vertcnt = len(geom)
+
+    _, indcs, offsets = label_parts(edges, vertcnt)
+    return [p.tolist() for p in np.split(indcs, offsets[1:-1])]
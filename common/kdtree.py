@@ -0,0 +1,339 @@
+import numpy as np
+
+from smorgasbord.common.io import get_part_bounds_and_centers
+
+
+def _box_dist_sq(pts, lo, hi):
+    """
+    Return the squared distance of each point to the corresponding
+    axis-aligned box given by its minimal and maximal corner. Points
+    inside their box have a distance of zero.
+    """
+    d = np.maximum(0, np.maximum(lo - pts, pts - hi))
+    return np.einsum('ij,ij->i', d, d)
+
+
+def _box_far_sq(pts, lo, hi):
+    """
+    Return the squared distance of each point to the farthest corner of
+    the corresponding axis-aligned box.
+    """
+    d = np.maximum(np.abs(lo - pts), np.abs(pts - hi))
+    return np.einsum('ij,ij->i', d, d)
+
+
+class BatchKDTree:
+    """
+    A balanced KD-tree over 3D points that is built from an array in
+    one call and answers whole batches of nearest-neighbour queries
+    with array operations instead of one Python call per point.
+
+    The tree is implicit: node i has the children 2i + 1 and 2i + 2,
+    and every node covers a contiguous range of the point indices
+    sorted by the tree. Each leaf holds at most 'leafsize' points.
+    All query points descend the tree together, level by level, and
+    the leaves each one needs to visit are evaluated in one go.
+
+    Subclasses can index other primitives than points by overriding
+    _prim_cnt(), _centers(), _prim_bounds(), _init_leaves(), and
+    _leaf_dists_sq().
+    """
+
+    # Whether no primitive reaches across the splitting plane of the
+    # nodes it's in. Only then is the distance to that plane a lower
+    # bound for the distance to any primitive on its other side.
+    _split_separates = True
+
+    def __init__(self, data, leafsize=16):
+        """
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Nx3 array of points to index.
+        leafsize : int = 16
+            Maximum number of points per leaf, though leaves hold up to
+            two points if it is 1. Bigger leaves make the tree shallower
+            at the expense of more distance computations per visited
+            leaf.
+        """
+        self.data = np.asarray(data, dtype=np.float64).reshape(-1, 3)
+        n = self._prim_cnt()
+        # Leaves must not be empty, or the splitting values of their
+        # parents come from a neighbouring node
+        self.depth = min(
+            int(np.ceil(np.log2(n / leafsize))),
+            int(np.floor(np.log2(n))),
+            ) if n > leafsize else 0
+        nodecnt = 2 ** self.depth - 1
+        self.axes = np.empty(nodecnt, dtype=np.int64)
+        self.splits = np.empty(nodecnt)
+
+        # Split every node of a level at the median of its widest axis.
+        # Nodes of a level cover equally sized ranges, so the bounds of
+        # all ranges are known in advance.
+        centrs = self._centers()
+        self.perm = np.arange(n)
+        for lvl in range(self.depth):
+            cnt = 2 ** lvl
+            bnds = np.arange(cnt + 1) * n // cnt
+            nodes = np.repeat(np.arange(cnt), np.diff(bnds))
+            # Nodes are contiguous already, no need to sort by them
+            co_min = np.minimum.reduceat(centrs, bnds[:-1])
+            extents = np.maximum.reduceat(centrs, bnds[:-1]) - co_min
+            axes = np.argmax(extents, axis=1)[nodes]
+
+            # Sort primitives within each node along its axis. Adding
+            # the coordinate, mapped to [0, 0.5], to the node index
+            # does so with one sort over all nodes.
+            c = centrs[np.arange(n), axes] - co_min[nodes, axes]
+            ext = extents[nodes, axes] * 2
+            key = np.divide(c, ext, out=np.zeros_like(c), where=ext > 0)
+            order = np.argsort(key + nodes)
+            # Points only move within their node, so keeping the
+            # centers sorted as well keeps memory accesses local
+            self.perm = self.perm[order]
+            centrs = centrs[order]
+
+            mids = np.arange(1, 2 * cnt, 2) * n // (2 * cnt)
+            axes = axes[bnds[:-1]]
+            self.axes[cnt - 1:2 * cnt - 1] = axes
+            self.splits[cnt - 1:2 * cnt - 1] = centrs[mids, axes]
+
+        # Primitive indices of each leaf, padded to the size of the
+        # biggest leaf by repeating the leaf's first primitive. Repeated
+        # primitives don't change any closest primitive found, which
+        # spares masking them out in every query.
+        leafcnt = 2 ** self.depth
+        bnds = np.arange(leafcnt + 1) * n // leafcnt
+        sizes = np.diff(bnds)
+        cols = np.arange(sizes.max(initial=1))
+        self.leaves = np.append(self.perm, 0)[bnds[:-1, np.newaxis]
+            + np.where(cols < sizes[:, np.newaxis], cols, 0)]
+
+        # Bounding box of every node, leaves first, then the inner nodes
+        # bottom-up from their children
+        self.lo = np.full((nodecnt + leafcnt, 3), np.inf)
+        self.hi = np.full_like(self.lo, -np.inf)
+        if n:
+            lo, hi = self._prim_bounds()
+            leaves = np.repeat(np.arange(leafcnt), sizes)
+            self.lo[nodecnt:], _, _, _ = get_part_bounds_and_centers(
+                lo[self.perm], leaves)
+            _, self.hi[nodecnt:], _, _ = get_part_bounds_and_centers(
+                hi[self.perm], leaves)
+        for lvl in range(self.depth - 1, -1, -1):
+            nodes = np.arange(2 ** lvl - 1, 2 ** (lvl + 1) - 1)
+            self.lo[nodes] = np.minimum(
+                self.lo[2 * nodes + 1], self.lo[2 * nodes + 2])
+            self.hi[nodes] = np.maximum(
+                self.hi[2 * nodes + 1], self.hi[2 * nodes + 2])
+
+        self._init_leaves()
+
+    def _prim_cnt(self):
+        """
+        Return the number of indexed primitives.
+        """
+        return len(self.data)
+
+    def _centers(self):
+        """
+        Return the Nx3 array of points the tree is split by.
+        """
+        return self.data
+
+    def _prim_bounds(self):
+        """
+        Return the minimal and maximal corner of the bounding box of
+        every primitive.
+        """
+        return self.data, self.data
+
+    def _init_leaves(self):
+        """
+        Prepare the data needed by _leaf_dists_sq() after the tree is
+        built.
+        """
+        # Copy the points of each leaf into one contiguous block
+        self._leafpts = np.append(self.data, np.zeros((1, 3)), axis=0)[
+            self.leaves]
+
+    def _leaf_dists_sq(self, pts, leaves):
+        """
+        Return the squared distance of every point to each of the
+        primitives in the corresponding leaf.
+        """
+        d = self._leafpts[leaves] - pts[:, np.newaxis]
+        return np.einsum('ijk,ijk->ij', d, d)
+
+    def _leaf_closest(self, pts, leaves):
+        """
+        For each point, return the index and the squared distance of
+        the closest primitive in the corresponding leaf.
+        """
+        d = self._leaf_dists_sq(pts, leaves)
+        args = np.argmin(d, axis=1)
+        rows = np.arange(len(pts))
+        return self.leaves[leaves, args], d[rows, args]
+
+    def _descend(self, pts):
+        """
+        Return the leaf each of the given points falls into.
+        """
+        nodes = np.zeros(len(pts), dtype=np.int64)
+        rows = np.arange(len(pts))
+        for _ in range(self.depth):
+            nodes = 2 * nodes + 1 \
+                + (pts[rows, self.axes[nodes]] >= self.splits[nodes])
+        return nodes - len(self.axes)
+
+    def _update_closest(self, pts, qs, nodes, indcs, dists, maxdist_sq):
+        """
+        Search the given (query, leaf node) pairs, sorted by query, for
+        primitives closer to the query points than the closest ones
+        found so far. Updates 'indcs' and 'dists' in place.
+        """
+        if not len(qs):
+            return
+
+        # Each query's leaves form a contiguous segment
+        pairindcs, pairdists = self._leaf_closest(
+            pts[qs], nodes - len(self.axes))
+        starts = np.flatnonzero(np.diff(qs, prepend=-1) != 0)
+        # Sorting by distance within the segments moves each one's
+        # closest pair to its start
+        ismin = np.lexsort((pairdists, qs))[starts]
+        mins = pairdists[ismin]
+        qs = qs[starts]
+
+        closer = (mins < dists[qs]) \
+            | ((indcs[qs] < 0) & (mins <= maxdist_sq))
+        qs = qs[closer]
+        indcs[qs] = pairindcs[ismin[closer]]
+        dists[qs] = mins[closer]
+
+    def query(self, pts, maxdist=np.inf, chunksize=2**14):
+        """
+        Find the closest primitive to each of the given points.
+
+        Parameters
+        ----------
+        pts : numpy.ndarray
+            Mx3 array of query points
+        maxdist : float = inf
+            Primitives farther away from a query point are ignored.
+        chunksize : int
+            Number of query points processed at once. Bounds memory
+            consumption.
+
+        Returns
+        -------
+        indcs : numpy.ndarray
+            Index of the closest primitive for every query point, -1
+            if none lies within 'maxdist'.
+        dists : numpy.ndarray
+            Distance to the closest primitive for every query point,
+            infinity if none lies within 'maxdist'.
+        """
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 3)
+        indcs = np.full(len(pts), -1, dtype=np.int64)
+        dists = np.full(len(pts), np.inf)
+        if not self._prim_cnt():
+            return indcs, dists
+
+        # Process query points in the order of the leaves they fall
+        # into, so that the points of a chunk visit the same parts of
+        # the tree
+        order = np.argsort(self._descend(pts), kind='stable')
+        for start in range(0, len(pts), chunksize):
+            chunk = order[start:start + chunksize]
+            indcs[chunk], dists[chunk] = \
+                self._query_chunk(pts[chunk], maxdist ** 2)
+        return indcs, np.sqrt(dists)
+
+    def _query_chunk(self, pts, maxdist_sq):
+        rows = np.arange(len(pts))
+
+        # Descend every point to the leaf it falls into to get an
+        # initial closest primitive. Remember the sibling of each node
+        # passed on the way.
+        # Also remember a lower bound for the distance to any primitive
+        # in the sibling: the squared distance to the splitting plane
+        # between both if possible, else to the sibling's box.
+        nodes = np.zeros(len(pts), dtype=np.int64)
+        sibls = np.empty((self.depth, len(pts)), dtype=np.int64)
+        gaps = np.empty((self.depth, len(pts)))
+        for lvl in range(self.depth):
+            if self._split_separates:
+                gap = pts[rows, self.axes[nodes]] - self.splits[nodes]
+                right = gap >= 0
+                gaps[lvl] = gap ** 2
+            else:
+                # Overlapping children, descend into the closer one
+                left = 2 * nodes + 1
+                right = left + 1
+                ldist = _box_dist_sq(pts, self.lo[left], self.hi[left])
+                rdist = _box_dist_sq(pts, self.lo[right], self.hi[right])
+                right = rdist < ldist
+                gaps[lvl] = np.where(right, ldist, rdist)
+            nodes = 2 * nodes + 1 + right
+            sibls[lvl] = nodes + np.where(right, -1, 1)
+        indcs, dists = self._leaf_closest(pts, nodes - len(self.axes))
+        far = dists > maxdist_sq
+        indcs[far] = -1
+        dists[far] = maxdist_sq
+
+        # Walk down the tree level by level again, now only with the
+        # subtrees branching off each point's path. Keep every
+        # (query, node) pair whose node's box lies closer to the query
+        # point than the closest primitive can be.
+        bounds = dists.copy()
+        qs = np.empty(0, dtype=np.int64)
+        nodes = np.empty(0, dtype=np.int64)
+        lo = hi = np.empty((0, 3))
+        for lvl in range(self.depth):
+            seeds = gaps[lvl] <= bounds
+            qs = np.concatenate((np.repeat(qs, 2), rows[seeds]))
+            children = np.repeat(2 * nodes + 1, 2)
+            children[1::2] += 1
+            nodes = np.concatenate((children, sibls[lvl][seeds]))
+            lo = self.lo[nodes]
+            hi = self.hi[nodes]
+            near = _box_dist_sq(pts[qs], lo, hi) <= bounds[qs]
+            qs = qs[near]
+            nodes = nodes[near]
+            # No primitive in a node is farther away than the node box's
+            # farthest corner, which tightens the bound for the levels
+            # below
+            lo = lo[near]
+            hi = hi[near]
+            np.minimum.at(bounds, qs, _box_far_sq(pts[qs], lo, hi))
+
+        # Drop the leaves ruled out by the bound of the last level
+        boxdists = _box_dist_sq(pts[qs], lo, hi)
+        near = boxdists <= bounds[qs]
+        qs = qs[near]
+        nodes = nodes[near]
+        boxdists = boxdists[near]
+
+        if self._split_separates:
+            order = np.argsort(qs, kind='stable')
+            self._update_closest(
+                pts, qs[order], nodes[order], indcs, dists, maxdist_sq)
+        else:
+            # The initial leaf may be far off, e.g. for query points off
+            # a surface. Visit the closest leaf of each query first, the
+            # primitive found there usually rules out most of the others.
+            order = np.lexsort((boxdists, qs))
+            qs = qs[order]
+            nodes = nodes[order]
+            boxdists = boxdists[order]
+            first = np.diff(qs, prepend=-1) != 0
+            self._update_closest(
+                pts, qs[first], nodes[first], indcs, dists, maxdist_sq)
+            near = ~first & (boxdists <= dists[qs])
+            self._update_closest(
+                pts, qs[near], nodes[near], indcs, dists, maxdist_sq)
+
+        dists[indcs < 0] = np.inf
+        return indcs, dists
@@ -0,0 +1,204 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from smorgasbord.common.descriptors import get_descriptor
+
+
+# State of a worker process, set by _init_worker()
+_worker = {}
+
+
+def _attach(name):
+    """
+    Open an existing shared memory block without letting this process
+    unlink it on exit, which is left to the creating process.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks, but with the spawn start method
+        # the resource tracker is the parent's, which unlinks the
+        # block only once
+        return shared_memory.SharedMemory(name=name)
+
+
+def _share(arrays, dtype):
+    """
+    Copy a list of Nx3 arrays into one shared memory block.
+
+    Returns
+    -------
+    shm : multiprocessing.shared_memory.SharedMemory
+        Block holding all arrays one after another
+    offsets : numpy.ndarray
+        Row each array starts at, followed by the total row count
+    """
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    # Blocks can't be empty
+    shm = shared_memory.SharedMemory(
+        create=True,
+        size=max(1, int(offsets[-1]) * 3 * np.dtype(dtype).itemsize),
+        )
+    buf = np.ndarray((offsets[-1], 3), dtype=dtype, buffer=shm.buf)
+    for a, start, stop in zip(arrays, offsets, offsets[1:]):
+        buf[start:stop] = a
+    # Release the view so the block can be closed
+    del buf
+    return shm, offsets
+
+
+def _init_worker(vname, vcnt, tname, tcnt, params):
+    vshm = _attach(vname)
+    tshm = _attach(tname)
+    _worker.update(
+        vshm=vshm,
+        tshm=tshm,
+        verts=np.ndarray((vcnt, 3), dtype=np.float64, buffer=vshm.buf),
+        tris=np.ndarray((tcnt, 3), dtype=np.int32, buffer=tshm.buf),
+        params=params,
+        )
+
+
+def _comp_jobs(jobs):
+    return [
+        (i, get_descriptor(
+            kind,
+            _worker['verts'][vstart:vstop],
+            _worker['tris'][tstart:tstop],
+            *_worker['params'],
+            ))
+        for i, kind, vstart, vstop, tstart, tstop in jobs
+        ]
+
+
+class DescriptorPool:
+    """
+    Computes shape descriptors of many meshes in a pool of processes
+    in the background, so the caller can collect finished ones while
+    doing other work. The mesh data is passed to the processes via
+    shared memory, so it is not copied for each of them. For a given
+    seed, the results equal the ones of get_descriptor().
+    """
+
+    def __init__(self, jobs, samplecnt, bincnt, maxpairs=None, seed=None,
+                 procs=None, executable=None):
+        """
+        Parameters
+        ----------
+        jobs : list
+            One (kind, pts, tris) tuple per descriptor to compute, as
+            passed to get_descriptor()
+        samplecnt, bincnt, maxpairs, seed
+            As passed to get_descriptor()
+        procs : int or None = None
+            Number of processes, the CPU count if None
+        executable : str or None = None
+            Python interpreter to start processes with, if it is not
+            sys.executable, as in Blender before 2.91
+        """
+        self.left = len(jobs)
+        self._pool = None
+        procs = max(1, min(procs or mp.cpu_count(), len(jobs)))
+        self._vshm, voffs = _share([j[1] for j in jobs], np.float64)
+        self._tshm, toffs = _share([j[2] for j in jobs], np.int32)
+        if not jobs:
+            return
+        try:
+            tasks = [
+                (i, j[0], voffs[i], voffs[i + 1], toffs[i], toffs[i + 1])
+                for i, j in enumerate(jobs)
+                ]
+            # Chunk tasks here, as the pool's own chunking doesn't allow
+            # waiting for results with a timeout
+            step = max(1, len(tasks) // (4 * procs))
+            chunks = [
+                tasks[i:i + step] for i in range(0, len(tasks), step)]
+            # Forking a process that embeds Python, like Blender, is
+            # unsafe, so always start fresh interpreters
+            ctx = mp.get_context('spawn')
+            if executable:
+                ctx.set_executable(executable)
+            self._pool = ctx.Pool(
+                procs,
+                initializer=_init_worker,
+                initargs=(
+                    self._vshm.name, voffs[-1], self._tshm.name, toffs[-1],
+                    (samplecnt, bincnt, maxpairs, seed),
+                    ),
+                )
+            self._results = self._pool.imap_unordered(_comp_jobs, chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def collect(self, timeout=0):
+        """
+        Return the descriptors finished since the last call.
+
+        Parameters
+        ----------
+        timeout : float or None = 0
+            Seconds to wait for the first descriptor if none is
+            finished yet. None waits until one is.
+
+        Returns
+        -------
+        done : list
+            (job index, descriptor) tuple of every finished descriptor
+        """
+        done = []
+        while self.left:
+            try:
+                chunk = self._results.next(timeout)
+            except mp.TimeoutError:
+                break
+            done += chunk
+            self.left -= len(chunk)
+            # Only wait for the first one
+            timeout = 0
+        return done
+
+    def close(self):
+        """
+        Stop all processes, dropping unfinished descriptors, and free
+        the shared memory.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for shm in (self._vshm, self._tshm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self._vshm = self._tshm = None
+        self.left = 0
+
+
+def comp_descriptors(jobs, samplecnt, bincnt, maxpairs=None, seed=None,
+                     procs=None, executable=None):
+    """
+    Compute shape descriptors of many meshes in a pool of processes
+    and wait for all of them. Parameters are the ones of
+    DescriptorPool().
+
+    Returns
+    -------
+    descs : list
+        Descriptor of every job
+    """
+    if not jobs:
+        return []
+    pool = DescriptorPool(
+        jobs, samplecnt, bincnt, maxpairs, seed, procs, executable)
+    descs = [None] * len(jobs)
+    try:
+        while pool.left:
+            for i, desc in pool.collect(None):
+                descs[i] = desc
+    finally:
+        pool.close()
+    return descs
@@ -0,0 +1,230 @@
+import numpy as np
+
+
+# Identifier of pixels not covered by any triangle
+NO_TRI = -1
+
+
+def _clip_near(clip, tris):
+    """
+    Clip triangles against the near plane in homogeneous clip space,
+    like the GPU does before rasterization.
+
+    Parameters
+    ----------
+    clip : numpy.ndarray
+        4xN array of clip space vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
+
+    Returns
+    -------
+    corners : numpy.ndarray
+        Mx3x4 array of clip space triangle corners, all in front of
+        the near plane
+    ids : numpy.ndarray
+        Index in 'tris' of the triangle each of the M triangles stems
+        from
+    """
+    corners = clip.T[tris]
+    # Signed distance to the near plane z = -w
+    dists = corners[:, :, 2] + corners[:, :, 3]
+    inside = dists >= 0
+    incnt = inside.sum(axis=1)
+    ids = np.arange(len(tris))
+
+    out = [corners[incnt == 3]]
+    outids = [ids[incnt == 3]]
+    for cnt in (1, 2):
+        sel = incnt == cnt
+        if not sel.any():
+            continue
+        # Rotate the corners, keeping the winding, so the one corner
+        # on the lonely side of the plane comes first
+        first = np.argmax(inside[sel] if cnt == 1 else ~inside[sel], axis=1)
+        order = (first[:, np.newaxis] + np.arange(3)) % 3
+        a, b, c = np.moveaxis(
+            np.take_along_axis(corners[sel], order[:, :, np.newaxis], 1),
+            1, 0)
+        da, db, dc = np.take_along_axis(dists[sel], order, 1).T
+        # Points where the edges from the first corner cross the plane
+        ab = a + (b - a) * (da / (da - db))[:, np.newaxis]
+        ac = a + (c - a) * (da / (da - dc))[:, np.newaxis]
+        if cnt == 1:
+            out.append(np.stack((a, ab, ac), axis=1))
+            outids.append(ids[sel])
+        else:
+            # The part in front is a quad, split into two triangles
+            out += [np.stack((b, c, ac), axis=1),
+                    np.stack((b, ac, ab), axis=1)]
+            outids += [ids[sel]] * 2
+    return np.concatenate(out), np.concatenate(outids)
+
+
+def _setup(corners, dim):
+    """
+    Compute the screen space edge functions, depth planes and pixel
+    bounds of triangles.
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Tx3x3 array holding the coefficients (a, b, c) of each edge
+        function a*x + b*y + c, which is non-negative inside
+    planes : numpy.ndarray
+        Tx3 array holding the coefficients (a, b, c) of the depth
+        a*x + b*y + c in [0, 1]
+    bounds : numpy.ndarray
+        Tx4 int array of the first and last pixel column and row each
+        triangle's bounding box covers
+    keep : numpy.ndarray
+        Mask of triangles that are not degenerate and cover any pixel
+    """
+    # Perspective divide and viewport transform. Pixel (i, j) has its
+    # center at (i + .5, j + .5).
+    ndc = corners[:, :, :3] / corners[:, :, 3:]
+    x = (ndc[:, :, 0] + 1) * (dim * .5)
+    y = (ndc[:, :, 1] + 1) * (dim * .5)
+    z = ndc[:, :, 2] * .5 + .5
+
+    # Edge k runs between the two corners other than corner k
+    x1, x2 = np.roll(x, -1, axis=1), np.roll(x, -2, axis=1)
+    y1, y2 = np.roll(y, -1, axis=1), np.roll(y, -2, axis=1)
+    ea = y1 - y2
+    eb = x2 - x1
+    ec = x1 * y2 - x2 * y1
+    # Twice the signed area
+    area = ec.sum(axis=1)
+    keep = area != 0
+    # Flip clockwise triangles, as faces aren't culled
+    sign = np.sign(area)[:, np.newaxis]
+    edges = np.stack((ea * sign, eb * sign, ec * sign), axis=2)
+
+    # The edge functions normalized by the area are the barycentric
+    # coordinates, which weight the corner depths
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bary = edges / np.abs(area)[:, np.newaxis, np.newaxis]
+    planes = np.einsum('tk,tkc->tc', z, bary)
+
+    bounds = np.stack((
+        np.ceil(x.min(axis=1) - .5),
+        np.floor(x.max(axis=1) - .5),
+        np.ceil(y.min(axis=1) - .5),
+        np.floor(y.max(axis=1) - .5),
+        ), axis=1)
+    bounds = np.clip(bounds, 0, dim - 1).astype(np.int64)
+    keep &= (bounds[:, 0] <= bounds[:, 1]) & (bounds[:, 2] <= bounds[:, 3])
+    keep &= (x.max(axis=1) >= .5) & (x.min(axis=1) <= dim - .5)
+    keep &= (y.max(axis=1) >= .5) & (y.min(axis=1) <= dim - .5)
+    return edges, planes, bounds, keep
+
+
+def rasterize(verts, tris, mvp, dim, tilesize=8, chunksize=2**20):
+    """
+    Render the depth of triangles on the CPU, like an OpenGL depth
+    pass with the depth test 'LESS' into a buffer cleared to one.
+
+    Triangles are set up all at once and binned into square tiles of
+    the image by their bounding boxes. The depth test then runs on
+    all (tile, triangle) pairs in chunks, reducing the pairs of each
+    tile to the closest depth and triangle per pixel.
+
+    Parameters
+    ----------
+    verts : numpy.ndarray
+        Nx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
+    mvp : numpy.ndarray
+        4x4 Model View Projection matrix, as from make_proj_mat()
+    dim : int
+        Pixel count of the image along one axis
+    tilesize : int = 8
+        Pixel count of a tile along one axis
+    chunksize : int = 2**20
+        Number of pixels tested at once. Bounds memory consumption.
+
+    Returns
+    -------
+    depth : numpy.ndarray
+        'dim' x 'dim' float32 array of depth values in [0, 1], indexed
+        by row from the bottom, then by column
+    ids : numpy.ndarray
+        'dim' x 'dim' int array of the index in 'tris' of the triangle
+        seen in each pixel, NO_TRI where there is none
+    """
+    tris = np.asarray(tris).reshape(-1, 3)
+    clip = np.asarray(mvp, dtype=np.float64) @ np.vstack((
+        np.asarray(verts, dtype=np.float64).T,
+        np.ones(len(verts)),
+        ))
+    corners, triids = _clip_near(clip, tris)
+    edges, planes, bounds, keep = _setup(corners, dim)
+    edges, planes, bounds, triids = \
+        edges[keep], planes[keep], bounds[keep], triids[keep]
+
+    # Pair every triangle with the tiles its bounding box overlaps
+    tilecnt = -(-dim // tilesize)
+    tbounds = bounds // tilesize
+    tcols = tbounds[:, 1] - tbounds[:, 0] + 1
+    paircnts = tcols * (tbounds[:, 3] - tbounds[:, 2] + 1)
+    pairtris = np.repeat(np.arange(len(triids)), paircnts)
+    # Position of each pair among the ones of its triangle
+    offs = np.arange(len(pairtris)) \
+        - np.repeat(np.cumsum(paircnts) - paircnts, paircnts)
+    tx = tbounds[pairtris, 0] + offs % tcols[pairtris]
+    ty = tbounds[pairtris, 2] + offs // tcols[pairtris]
+    pairtiles = ty * tilecnt + tx
+    order = np.argsort(pairtiles, kind='stable')
+    pairtris = pairtris[order]
+    pairtiles = pairtiles[order]
+    del offs, tx, ty, order
+
+    # Depth and triangle of each pixel packed into one int64, so that a
+    # single minimum finds both. Bit patterns of non-negative floats
+    # sort like the floats.
+    cleared = (np.int64(np.float32(1).view(np.int32)) << 32) | 0xffffffff
+    keys = np.full((tilecnt * tilecnt, tilesize * tilesize), cleared)
+
+    # Pixel centers relative to the corner of their tile
+    py, px = np.divmod(np.arange(tilesize * tilesize), tilesize)
+    px = px + .5
+    py = py + .5
+    step = max(1, chunksize // (tilesize * tilesize))
+    for start in range(0, len(pairtris), step):
+        ptris = pairtris[start:start + step]
+        ptiles = pairtiles[start:start + step]
+        x = (ptiles % tilecnt * tilesize)[:, np.newaxis] + px
+        y = (ptiles // tilecnt * tilesize)[:, np.newaxis] + py
+
+        inside = np.ones(x.shape, dtype=bool)
+        for k in range(3):
+            e = edges[ptris, k]
+            inside &= e[:, 0:1] * x + e[:, 1:2] * y + e[:, 2:3] >= 0
+        p = planes[ptris]
+        depth = (p[:, 0:1] * x + p[:, 1:2] * y + p[:, 2:3]) \
+            .astype(np.float32)
+        # Fragments beyond the far plane are clipped
+        inside &= (0 <= depth) & (depth <= 1)
+        # Turn -0 into 0, as its bits would sort before all depths
+        depth[depth == 0] = 0
+
+        pkeys = (depth.view(np.int32).astype(np.int64) << 32) \
+            | triids[ptris].astype(np.int64)[:, np.newaxis]
+        pkeys[~inside] = cleared
+        # Pairs are sorted by tile, so each tile's pairs are contiguous
+        firsts = np.flatnonzero(np.diff(ptiles, prepend=-1))
+        utiles = ptiles[firsts]
+        keys[utiles] = np.minimum(
+            keys[utiles],
+            np.minimum.reduceat(pkeys, firsts, axis=0),
+            )
+
+    # Tiles to image, cropping the tiles poking out of it
+    keys = keys.reshape(tilecnt, tilecnt, tilesize, tilesize) \
+        .transpose(0, 2, 1, 3) \
+        .reshape(tilecnt * tilesize, tilecnt * tilesize)[:dim, :dim]
+    depth = (keys >> 32).astype(np.int32).view(np.float32)
+    ids = (keys & 0xffffffff).astype(np.int64)
+    ids[ids == 0xffffffff] = NO_TRI
+    return depth, ids
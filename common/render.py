@@ -0,0 +1,282 @@
+import gpu
+import numpy as np
+from math import ceil, sqrt
+
+from gpu_extras.batch import batch_for_shader
+from mathutils import Matrix
+
+
+_VERT_DEPTH = '''
+uniform mat4 mvp;
+in vec3 pos;
+void main() {
+    gl_Position = mvp * vec4(pos, 1);
+}'''
+
+_FRAG_DEPTH = '''
+out vec4 col;
+void main() {
+    col = vec4(0, 0, 1, 1);
+}'''
+
+_VERT_ID = '''
+uniform mat4 mvp;
+in vec3 pos;
+in vec2 id;
+flat out vec2 fid;
+void main() {
+    gl_Position = mvp * vec4(pos, 1);
+    fid = id;
+}'''
+
+# Gets the ID plus one split into its low and high 16 bits, as floats
+# represent integers exactly only up to 2^24, and writes it into the
+# red, green, blue, and alpha byte, least significant first. Zero
+# remains for the cleared background.
+_FRAG_ID = '''
+flat in vec2 fid;
+out vec4 col;
+void main() {
+    col = vec4(
+        mod(fid.x, 256.0),
+        floor(fid.x / 256.0),
+        mod(fid.y, 256.0),
+        floor(fid.y / 256.0)
+    ) / 255.0;
+}'''
+
+
+class DepthReader:
+    """
+    Reads the depth buffer of framebuffers into one reused buffer,
+    avoiding a round-trip through a Python list.
+    """
+    _fmt = 'FLOAT'
+    _dtype = np.float32
+    _shape = ()
+
+    def __init__(self, width, height=None):
+        """
+        Parameters
+        ----------
+        width : int
+            Pixel count of the read region along the horizontal axis
+        height : int or None = None
+            Pixel count along the vertical axis, 'width' if None
+        """
+        self.width = width
+        self.height = height or width
+        self._buf = gpu.types.Buffer(
+            self._fmt, (self.height, width) + self._shape)
+        # Whether the read functions can fill a given buffer, which
+        # they can't before Blender 3.0
+        self._fill = True
+
+    def _read(self, framebuffer, **kwargs):
+        return framebuffer.read_depth(
+            0, 0, self.width, self.height, **kwargs)
+
+    def __call__(self, framebuffer):
+        """
+        Read a framebuffer's depth values.
+
+        Parameters
+        ----------
+        framebuffer : gpu.types.GPUFrameBuffer
+            Framebuffer of at least 'width' x 'height' pixels
+
+        Returns
+        -------
+        depth : numpy.ndarray
+            'height' x 'width' float32 array of depth values in [0, 1].
+            May share memory with the buffer, so it is only valid until
+            the next call.
+        """
+        buf = self._buf
+        if self._fill:
+            try:
+                self._read(framebuffer, data=buf)
+            except TypeError:
+                self._fill = False
+        if not self._fill:
+            buf = self._read(framebuffer)
+
+        try:
+            # Buffers support the buffer protocol since Blender 2.93
+            vals = np.frombuffer(buf, dtype=self._dtype)
+        except (TypeError, ValueError):
+            vals = np.array(buf.to_list(), dtype=self._dtype)
+        return vals.reshape((self.height, self.width) + self._shape)
+
+
+class ColorReader(DepthReader):
+    """
+    Reads the first color attachment of framebuffers as RGBA bytes
+    into one reused buffer. Calls return a 'height' x 'width' x 4
+    uint8 array.
+    """
+    _fmt = 'UBYTE'
+    _dtype = np.uint8
+    _shape = (4,)
+
+    def _read(self, framebuffer, **kwargs):
+        return framebuffer.read_color(
+            0, 0, self.width, self.height, 4, 0, 'UBYTE', **kwargs)
+
+
+def gpu_available():
+    """
+    Return whether offscreen buffers can be rendered into, which they
+    can't in background mode without a GPU.
+    """
+    try:
+        gpu.types.GPUOffScreen(1, 1).free()
+    except Exception:
+        return False
+    return True
+
+
+def _render(shader, attrs, indices, mvps, dim, reader, perpass):
+    """
+    Draw a batch once per Model View Projection matrix with depth
+    testing, and return what a reader reads from each view.
+
+    Views are rendered into the tiles of one offscreen atlas, 'perpass'
+    at a time, so binding, clearing, and reading back the atlas happens
+    once per pass instead of once per view.
+    """
+    # The atlas can't grow larger than a texture can
+    tilemax = (gpu.capabilities.max_texture_size_get() // dim) ** 2
+    perpass = max(1, min(perpass, len(mvps), tilemax))
+    cols = ceil(sqrt(perpass))
+    rows = ceil(perpass / cols)
+    offbuf = gpu.types.GPUOffScreen(cols * dim, rows * dim)
+    read = reader(cols * dim, rows * dim)
+    shader.bind()
+    batch = batch_for_shader(shader, 'TRIS', attrs, indices=indices)
+    batch.program_set(shader)
+
+    results = []
+    for start in range(0, len(mvps), perpass):
+        passmvps = mvps[start:start + perpass]
+        with offbuf.bind():
+            framebuffer = gpu.state.active_framebuffer_get()
+            gpu.state.depth_mask_set(True)
+            framebuffer.clear(color=(0, 0, 0, 0), depth=1.0)
+            gpu.state.depth_test_set('LESS')
+            for i, mvp in enumerate(passmvps):
+                # Clip space maps to the view's tile only, so views
+                # don't bleed into each other
+                row, col = divmod(i, cols)
+                gpu.state.viewport_set(col * dim, row * dim, dim, dim)
+                shader.uniform_float("mvp", Matrix(mvp))
+                batch.draw()
+
+            # Write texture back to CPU
+            atlas = read(framebuffer)
+            # Have to reset the state to not hit https://projects.blender.org/blender/blender/issues/98486
+            gpu.state.depth_mask_set(False)
+            gpu.state.depth_test_set('NONE')
+
+        # Cut the atlas into views, copying them out of the reused
+        # buffer
+        for i in range(len(passmvps)):
+            row, col = divmod(i, cols)
+            results.append(atlas[
+                row * dim:(row + 1) * dim,
+                col * dim:(col + 1) * dim,
+                ].copy())
+
+    offbuf.free()
+    return results
+
+
+def render_depths(verts, tris, mvps, dim, perpass=1):
+    """
+    Render triangles on the GPU once per Model View Projection matrix
+    and return the depth buffers.
+
+    Parameters
+    ----------
+    verts : numpy.ndarray
+        Nx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
+    mvps : Iterable
+        4x4 Model View Projection matrices, as from make_proj_mat()
+    dim : int
+        Pixel count of the images along one axis
+    perpass : int = 1
+        Number of views rendered into one atlas and read back at once.
+        Saves round trips between CPU and GPU, but needs more memory.
+
+    Returns
+    -------
+    depths : list[numpy.ndarray]
+        'dim' x 'dim' float32 array of depth values in [0, 1] per
+        matrix, indexed by row from the bottom, then by column
+    """
+    shader = gpu.types.GPUShader(
+        vertexcode=_VERT_DEPTH,
+        fragcode=_FRAG_DEPTH,
+        )
+    return _render(
+        shader, {"pos": verts}, tris, mvps, dim, DepthReader, perpass)
+
+
+def render_ids(verts, tris, mvps, dim, perpass=1, vertids=None):
+    """
+    Render the index of the closest triangle in every pixel on the GPU
+    once per Model View Projection matrix. Parameters are the ones of
+    render_depths(), plus:
+
+    Parameters
+    ----------
+    vertids : numpy.ndarray or None = None
+        ID of every vertex to render instead of the triangle indices,
+        the same for all corners of a triangle, e.g. the index of the
+        object owning it. Allows drawing indexed triangles, and needs
+        fewer distinct IDs.
+
+    Returns
+    -------
+    ids : list[numpy.ndarray]
+        'dim' x 'dim' int array of triangle indices in 'tris', or IDs
+        in 'vertids', per matrix, -1 (NO_TRI in
+        smorgasbord.common.raster) where there is no triangle
+    """
+    tris = np.asarray(tris).reshape(-1, 3)
+    if vertids is None:
+        idcnt = len(tris)
+    else:
+        vertids = np.asarray(vertids)
+        idcnt = vertids.max(initial=-1) + 1
+    if idcnt >= 2**32:
+        raise ValueError("Can't tell 2^32 or more IDs apart")
+    shader = gpu.types.GPUShader(
+        vertexcode=_VERT_ID,
+        fragcode=_FRAG_ID,
+        )
+    if vertids is None:
+        # Each corner needs the index of its triangle, so no corner can
+        # be shared between triangles
+        pos = np.asarray(verts)[tris].reshape(-1, 3)
+        ids = np.repeat(np.arange(1, len(tris) + 1), 3)
+        tris = None
+    else:
+        pos = verts
+        ids = vertids.astype(np.int64) + 1
+    attrs = {
+        "pos": pos,
+        "id": np.stack((ids & 0xffff, ids >> 16), axis=1)
+            .astype(np.float32),
+    }
+    cols = _render(shader, attrs, tris, mvps, dim, ColorReader, perpass)
+    ids = []
+    for c in cols:
+        c = c.astype(np.int64)
+        ids.append((
+            c[:, :, 0] | c[:, :, 1] << 8 | c[:, :, 2] << 16
+            | c[:, :, 3] << 24
+            ) - 1)
+    return ids
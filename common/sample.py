@@ -1,26 +1,24 @@
-import bpy
-import bmesh as bm
 import numpy as np
 
-from random import random
 from smorgasbord.common.io import get_scalars, get_vecs
 
 
-def sample_mesh(mesh, samplecnt=1024, mask=None):
+def sample_tris(pts, tris, samplecnt=1024, seed=None):
     """
-    Draw N random samples on the surface of a triangle mesh.
+    Draw N random samples on the surface of a triangle mesh given as
+    arrays.
 
     Parameters
     ----------
-    mesh : bpy.types.Mesh
-        Blender mesh to sample from.
+    pts : numpy.ndarray
+        Vx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
     samplecnt : int = 1024
         Number of samples to use.
-    mask : Iterable or None = None
-        Iterable specifying the faces from which to sample either by
-        passing their index in the mesh's face list as an Integer
-        iterable or as a Bool iterable where that specific index is set
-        to True. If None is passed, every face is sampled.
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw samples with. The same seed yields
+        the same samples.
 
     Returns
     -------
@@ -28,30 +26,22 @@ def sample_mesh(mesh, samplecnt=1024, mask=None):
         2D array with shape (N, 3), containing the coordinates of the
         N drawn sample points.
     """
-    # Load mesh into bmesh,
-    bob = bm.new()
-    bob.from_mesh(mesh, face_normals=False)
-    if mask is not None:
-        bfaces = np.array(bob.faces)
-        invmask = np.ones(len(bfaces), dtype=bool)
-        invmask[mask] = False
-        bm.ops.delete(bob, geom=bfaces[invmask], context='FACES')
-        del bfaces, invmask
-
-    # triangulate it,
-    bm.ops.triangulate(bob, faces=bob.faces)
-    # and save it back to a temporary mesh, so that we can use
-    # Blenders' fast-access foreach functions to get vectorized data.
-    mesh = bpy.data.meshes.new("tmp")
-    bob.to_mesh(mesh)
-    del bob
+    rng = np.random.default_rng(seed)
+    # Outer indexing operation: For each vertex index in the triangle
+    # array, insert its actual vertex coordinates.
+    tris = np.asanyarray(pts)[tris]
 
     # Accumulate all triangle areas in the mesh to sample each triangle
-    # with a probability proportional to its surface area.
-    areas = get_scalars(mesh.polygons, 'area', np.float64)
+    # with a probability proportional to its surface area. The area
+    # is half the length of the cross product of two edges, the factor
+    # doesn't change the proportions though.
+    areas = np.linalg.norm(
+        np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]),
+        axis=1,
+        )
     areas = np.cumsum(areas)
     # Choose N random floats between 0 and the sum of all areas.
-    rdareas = np.random.uniform(0., areas[-1], samplecnt)
+    rdareas = rng.uniform(0., areas[-1], samplecnt)
     # For each random float, find the index of the triangle with the
     # highest, but less equal cumulative area (the left neighbor of the
     # randomly drawn area).
@@ -60,29 +50,18 @@ def sample_mesh(mesh, samplecnt=1024, mask=None):
     # unneeded data applicable for garbage collection.
     del areas, rdareas
 
-    # Get the vertex coordinates.
-    pts = get_vecs(mesh.vertices)
-    # Get the vertex indices for each triangle.
-    tris = get_vecs(mesh.polygons, 'vertices', dtype=np.int32)
-    bpy.data.meshes.remove(mesh)
-    # Inner indexing operation: For each randomly chosen triangle index,
-    # insert the actual vertex indices of the corresponding triangle
-    # into the array.
-    # Outer indexing operation: For each vertex index in the triangle
-    # array, insert its actual vertex coordinates.
-    # This 3D array holds a lot of redundant data now, this probably
-    # scales pretty badly with the sample count and the number of
-    # triangles.
-    tris = pts[tris[rdindcs, :]]
-    del rdindcs, pts
+    # For each randomly chosen triangle index, insert the vertex
+    # coordinates of the corresponding triangle into the array.
+    tris = tris[rdindcs]
+    del rdindcs
 
     # For each sample, draw two random floats that determine where on
     # the triangle the sample point is placed.
     # This is done via the following formula, with the triangle's
     # vertex coordinate vectors A, B, C:
     # P = (1 - sqrt(r1))*A + sqrt(r1)*(1 - r2)*B + sqrt(r1)*r2*C
-    r1 = np.sqrt(np.random.rand(samplecnt))
-    r2 = np.random.rand(samplecnt)
+    r1 = np.sqrt(rng.random(samplecnt))
+    r2 = rng.random(samplecnt)
     # Calculate coefficients for each vertex A, B, C
     coef = np.stack(
         (1 - r1, r1 * (1 - r2), r1 * r2),
@@ -95,72 +74,268 @@ def sample_mesh(mesh, samplecnt=1024, mask=None):
     return np.sum(coef * tris, axis=1)
 
 
-def get_shape_distrib(points, bincnt=32):
+def get_tris(mesh, mask=None):
+    """
+    Return a mesh's vertex coordinates and its triangulation as
+    arrays.
+
+    Parameters
+    ----------
+    mesh : bpy.types.Mesh
+        Blender mesh to read
+    mask : Iterable or None = None
+        Only return triangles of faces given by their index or by a
+        Bool iterable. If None is passed, every face is returned.
+
+    Returns
+    -------
+    pts : numpy.ndarray
+        Nx3 array of vertex coordinates
+    tris : numpy.ndarray
+        Tx3 int array of vertex indices of each triangle
     """
-    Calculate a shape distribution from a set of points.
-    :param points: List-like object of points to calculate the
-        distribution for.
-    :param bincnt: Resolution of the distribution: the bin count
-        of the histogram representing the distribution.
+    # Read the mesh's triangulation directly instead of triangulating
+    # a copy of it
+    mesh.calc_loop_triangles()
+    ltris = mesh.loop_triangles
+    tris = get_vecs(ltris, 'vertices', dtype=np.int32)
+
+    if mask is not None:
+        # Only keep triangles of masked faces
+        facemask = np.zeros(len(mesh.polygons), dtype=bool)
+        facemask[mask] = True
+        tris = tris[facemask[get_scalars(ltris, 'polygon_index', np.int32)]]
+
+    return get_vecs(mesh.vertices), tris
+
+
+def sample_mesh(mesh, samplecnt=1024, mask=None, seed=None):
+    """
+    Draw N random samples on the surface of a mesh.
+
+    Parameters
+    ----------
+    mesh : bpy.types.Mesh
+        Blender mesh to sample from.
+    samplecnt : int = 1024
+        Number of samples to use.
+    mask : Iterable or None = None
+        Iterable specifying the faces from which to sample either by
+        passing their index in the mesh's face list as an Integer
+        iterable or as a Bool iterable where that specific index is set
+        to True. If None is passed, every face is sampled.
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw samples with
+
+    Returns
+    -------
+    out : numpy.ndarray
+        2D array with shape (N, 3), containing the coordinates of the
+        N drawn sample points.
+    """
+    return sample_tris(*get_tris(mesh, mask), samplecnt, seed)
+
+
+def _pair_dists(points, chunksize):
+    """
+    Yield the distances of all unordered pairs of distinct points in
+    blocks of about 'chunksize' pairs, without ever holding all pairs
+    in memory.
+    """
+    n = len(points)
+    rowcnt = max(1, chunksize // max(n, 1))
+    for start in range(0, n - 1, rowcnt):
+        rows = points[start:start + rowcnt]
+        # Compare each row only with the points after it
+        cols = points[start + 1:]
+        d = np.linalg.norm(rows[:, np.newaxis] - cols, axis=2)
+        upper = np.arange(len(cols)) >= np.arange(len(rows))[:, np.newaxis]
+        yield d[upper]
+
+
+def get_shape_distrib(points, bincnt=32, maxpairs=None, seed=None,
+                      chunksize=2**20):
+    """
+    Calculate a shape distribution from a set of points: the
+    histogram of the distances between all pairs of points.
+
+    Pairs are processed in blocks, so memory consumption is bounded by
+    'chunksize' instead of growing with the square of the point count.
+    The exact histogram takes two passes over all pairs: one to find
+    the range of distances, one to count them into fixed bins.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Nx3 array of points to calculate the distribution for.
+    bincnt : int = 32
+        Resolution of the distribution: the bin count of the histogram
+        representing the distribution.
+    maxpairs : int or None = None
+        If given and less than the number of pairs, estimate the
+        distribution from this many random pairs instead.
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw random pairs with
+    chunksize : int = 2**20
+        Number of pairs processed at once
+
+    Returns
+    -------
+    hist : numpy.ndarray
+        Number of pairs in each bin
+    bins : numpy.ndarray
+        Bin edges, as returned by numpy.histogram()
     """
     points = np.asanyarray(points)
-    # k=1 eliminates diagonal indices
-    i, j = np.triu_indices(len(points), k=1)
-    return np.histogram(
-        np.linalg.norm(points[i] - points[j], axis=1),
-        bins=bincnt,
-        )
+    n = len(points)
+
+    if maxpairs is not None and maxpairs < n * (n - 1) // 2:
+        # Draw random pairs of distinct points
+        rng = np.random.default_rng(seed)
+        i = rng.integers(0, n, maxpairs)
+        j = rng.integers(0, n - 1, maxpairs)
+        j[j >= i] += 1
+        d = np.linalg.norm(points[i] - points[j], axis=1)
+        return np.histogram(d, bins=bincnt)
+
+    # First pass: find the range numpy.histogram() would choose
+    lo = np.inf
+    hi = -np.inf
+    for d in _pair_dists(points, chunksize):
+        if len(d):
+            lo = min(lo, d.min())
+            hi = max(hi, d.max())
+    if lo > hi:
+        # Less than two points
+        return np.histogram(np.empty(0), bins=bincnt)
+
+    # Second pass: count pairs into the now fixed bins
+    hist = np.zeros(bincnt, dtype=np.int64)
+    for d in _pair_dists(points, chunksize):
+        h, bins = np.histogram(d, bins=bincnt, range=(lo, hi))
+        hist += h
+    return hist, bins
 
 
-def _sample_longitude(cosphi, radius):
+def scale_to_paircnt(hist, pointcnt):
+    """
+    Scale a shape distribution estimated from random pairs up to the
+    count of all pairs of 'pointcnt' points, to keep it comparable to
+    exact ones. Exact distributions are returned unchanged.
+    """
+    paircnt = pointcnt * (pointcnt - 1) // 2
+    total = hist.sum()
+    if 0 < total < paircnt:
+        hist = hist * (paircnt / total)
+    return hist
+
+
+def _sample_unit_square(samplecnt, method, rng):
+    """
+    Draw N points in [0, 1)^2, either independently at random, one per
+    row and column of an NxN grid (stratified), on a Fibonacci
+    lattice randomly shifted along its second axis, or from a randomly
+    shifted R2 sequence.
+    """
+    if method == 'RANDOM':
+        # Draw both coordinates of a point together, so the first
+        # points stay the same when more are drawn with the same seed
+        u, v = rng.random((samplecnt, 2)).T
+        return u, v
+    if method == 'STRATIFIED':
+        # Latin hypercube: jitter each point inside its own stratum on
+        # both axes, and pair up the strata at random
+        u = (rng.permutation(samplecnt) + rng.random(samplecnt)) \
+            / samplecnt
+        v = (rng.permutation(samplecnt) + rng.random(samplecnt)) \
+            / samplecnt
+        return u, v
+    if method == 'FIBONACCI':
+        i = np.arange(samplecnt)
+        u = (i + .5) / samplecnt
+        # Golden ratio minus one
+        v = (i * .6180339887498949 + rng.random()) % 1
+        return u, v
+    if method == 'SEQUENCE':
+        # Additive recurrence with the inverse powers of the plastic
+        # number. Low discrepancy like the lattice, but each prefix is
+        # as evenly spread as the whole sequence.
+        i = np.arange(1, samplecnt + 1)[:, np.newaxis]
+        u, v = ((i * (.7548776662466927, .5698402909980532)
+                 + rng.random(2)) % 1).T
+        return u, v
+    raise ValueError(f"Unknown sampling method '{method}'")
+
+
+def _sample_longitude(cosphi, theta, radius):
     """
     Common code of (hemi-)sphere sampling
     """
     phi = np.arccos(cosphi)
     sinphi = radius * np.sin(phi)
-    theta = 2 * np.pi * random()
-
-    x = sinphi * np.cos(theta)
-    y = sinphi * np.sin(theta)
-    z = radius * cosphi
-    return (x, y, z), (theta, phi)
+    pts = np.column_stack((
+        sinphi * np.cos(theta),
+        sinphi * np.sin(theta),
+        radius * cosphi,
+        ))
+    return pts, (theta, phi)
 
 
-def sample_hemisphere(radius):
+def sample_hemisphere(radius, samplecnt=1, method='RANDOM', seed=None):
     """
-    Sample a random point on a upwards-oriented hemisphere.
+    Sample points on a upwards-oriented hemisphere, denser towards its
+    pole.
 
     Parameters
     ----------
     radius : number
         Radius of the hemisphere
+    samplecnt : int = 1
+        Number of points to sample
+    method : str = 'RANDOM'
+        'RANDOM' for independent points, 'STRATIFIED' for random points
+        spread more evenly, 'FIBONACCI' for points on a spiral
+        lattice, which covers the domain most evenly, or 'SEQUENCE'
+        for a low-discrepancy sequence, whose first points stay the
+        same and evenly spread when more are drawn
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw points with. The same seed yields
+        the same points.
 
     Returns
     -------
-    out : tuple[tuple]
-        First element is a tuple with XYZ coordinates of the sampled
-        point. Second element is a tuple with the polar coordinates
-        (theta, phi) of the same point.
+    pts : numpy.ndarray
+        Nx3 array with the XYZ coordinates of the sampled points
+    angles : tuple[numpy.ndarray]
+        Polar coordinates (theta, phi) of the same points
     """
-    cosphi = np.sqrt(random())
-    return _sample_longitude(cosphi, radius)
+    u, v = _sample_unit_square(
+        samplecnt, method, np.random.default_rng(seed))
+    return _sample_longitude(np.sqrt(u), 2 * np.pi * v, radius)
 
 
-def sample_sphere(radius):
+def sample_sphere(radius, samplecnt=1, method='RANDOM', seed=None):
     """
-    Sample a random point on a sphere
+    Sample points uniformly on a sphere
 
     Parameters
     ----------
     radius : number
         Radius of the sphere
+    samplecnt : int = 1
+        Number of points to sample
+    method : str = 'RANDOM'
+        How to sample, as in sample_hemisphere()
+    seed : int, numpy.random.Generator, or None = None
+        Seed or generator to draw points with
 
     Returns
     -------
-    out : tuple[tuple]
-        First element is a tuple with XYZ coordinates of the sampled
-        point. Second element is a tuple with the polar coordinates
-        (theta, phi) of the same point.
+    pts : numpy.ndarray
+        Nx3 array with the XYZ coordinates of the sampled points
+    angles : tuple[numpy.ndarray]
+        Polar coordinates (theta, phi) of the same points
     """
-    cosphi = 2 * random() - 1
-    return _sample_longitude(cosphi, radius)
+    u, v = _sample_unit_square(
+        samplecnt, method, np.random.default_rng(seed))
+    return _sample_longitude(1 - 2 * u, 2 * np.pi * v, radius)
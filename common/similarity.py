@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class SimilarityIndex:
+    """
+    Shape descriptors of many objects stacked into one matrix, to
+    compare them all at once by their L1 distance.
+    """
+
+    def __init__(self, descs, chunksize=2**22):
+        """
+        Parameters
+        ----------
+        descs : Iterable
+            NxB array of one B-dimensional descriptor per object
+        chunksize : int = 2**22
+            Number of descriptor entries compared at once. Bounds
+            memory consumption.
+        """
+        self.descs = np.asarray(descs, dtype=np.float64)
+        if self.descs.ndim != 2:
+            self.descs = self.descs.reshape(len(self.descs), -1)
+        self.chunksize = chunksize
+
+    def __len__(self):
+        return len(self.descs)
+
+    def dists(self, query, indcs=None):
+        """
+        Return the L1 distance of every indexed descriptor to the
+        closest of the given query descriptors.
+
+        Parameters
+        ----------
+        query : numpy.ndarray
+            B or QxB array of query descriptors
+        indcs : numpy.ndarray or None = None
+            Only compare the descriptors with these indices, if given
+
+        Returns
+        -------
+        dists : numpy.ndarray
+            Distance of each (given) descriptor to its closest query
+        """
+        query = np.asarray(query, dtype=np.float64).reshape(
+            -1, self.descs.shape[1])
+        descs = self.descs if indcs is None else self.descs[indcs]
+        dists = np.full(len(descs), np.inf)
+        step = max(1, self.chunksize // max(1, query.size))
+        for start in range(0, len(descs), step):
+            chunk = descs[start:start + step]
+            d = np.abs(chunk[:, np.newaxis] - query).sum(axis=2)
+            dists[start:start + step] = d.min(axis=1)
+        return dists
+
+    def within(self, query, lo, hi):
+        """
+        Return the indices of all descriptors whose distance to the
+        query lies in [lo, hi), and those distances.
+        """
+        dists = self.dists(query)
+        indcs = np.flatnonzero((lo <= dists) & (dists < hi))
+        return indcs, dists[indcs]
+
+    def topk(self, query, k, exclude=None):
+        """
+        Return the indices of the k descriptors closest to the query,
+        from closest to farthest, and their distances.
+
+        Parameters
+        ----------
+        query : numpy.ndarray
+            B or QxB array of query descriptors
+        k : int
+            Number of descriptors to return
+        exclude : Iterable or None = None
+            Indices of descriptors never to return, for example the
+            ones of the query objects themselves
+        """
+        dists = self.dists(query)
+        if exclude is not None:
+            dists[np.asarray(exclude, dtype=np.int64)] = np.inf
+        k = min(k, np.count_nonzero(np.isfinite(dists)))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        # Only sort the k smallest
+        indcs = np.argpartition(dists, k - 1)[:k]
+        indcs = indcs[np.argsort(dists[indcs], kind='stable')]
+        return indcs, dists[indcs]
+
+    def cluster(self, thresh):
+        """
+        Partition the descriptors into groups of similar ones.
+
+        Uses leader clustering: the first descriptor not yet grouped
+        starts a new group and takes all ungrouped descriptors closer
+        than 'thresh' to it. Each step compares one leader against all
+        remaining descriptors at once.
+
+        Returns
+        -------
+        labels : numpy.ndarray
+            Group index of every descriptor, groups numbered in the
+            order of their leaders
+        """
+        labels = np.full(len(self.descs), -1, dtype=np.int64)
+        rest = np.arange(len(self.descs))
+        descs = self.descs
+        label = 0
+        while len(rest):
+            near = np.abs(descs - descs[0]).sum(axis=1) < thresh
+            # The leader itself is always in its group
+            near[0] = True
+            labels[rest[near]] = label
+            # Shrink the remaining descriptors so later leaders compare
+            # against fewer of them
+            far = ~near
+            rest = rest[far]
+            descs = descs[far]
+            label += 1
+        return labels
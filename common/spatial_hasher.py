@@ -1,5 +1,3 @@
-from collections import defaultdict
-from math import floor
 import numpy as np
 
 from smorgasbord.common.io import get_bounds_and_center
@@ -11,7 +9,7 @@ def _res_heur(data, *args, **kwargs):
     resolution of the voxel grid and correspondingly, how many
     points get hashed to the same value.
     """
-    return 3 * len(data) ** 0.33333333
+    return len(data) ** 0.33333333
 
 def quantize(pts, binlen):
     """
@@ -21,59 +19,147 @@ def quantize(pts, binlen):
     return binlen * np.round(np.asanyarray(pts) / binlen)
 
 
+def _expand(starts, ends):
+    """
+    Concatenate the index ranges [starts[i], ends[i]) into one flat
+    array without a Python loop.
+
+    Returns
+    -------
+    indcs : numpy.ndarray
+        Concatenated ranges
+    offsets : numpy.ndarray
+        Array of length len(starts) + 1. The indices of the i-th range
+        are indcs[offsets[i]:offsets[i + 1]].
+    """
+    counts = ends - starts
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    indcs = np.arange(offsets[-1]) \
+        - np.repeat(offsets[:-1] - starts, counts)
+    return indcs, offsets
+
+
+def _kernel(ring):
+    """
+    Return the offsets to all cells at most 'ring' cells away from a
+    cell along each axis.
+    """
+    o = np.arange(-ring, ring + 1)
+    return np.array(np.meshgrid(o, o, o)).T.reshape(-1, 3)
+
+
 class SpatialHasher:
     """
     A spatial hash for 3D coordinates, allowing fast look-up of
     neighboring data.
+
+    Points are binned into a uniform voxel grid. Instead of a dict of
+    cells, the grid is stored in compressed sparse row form: data
+    indices sorted by a packed integer key of their cell, plus the
+    start and end of each occupied cell in that order.
     """
 
+    # Offsets to all 3**3 = 27 cells around and including a cell
+    _kern = _kernel(1)
+
     def __init__(self, data, res_heuristic=_res_heur):
         """
-        @TODO document
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Nx3 array of points to hash.
+        res_heuristic : Callable = _res_heur
+            Called with the data, its bounds, and its center. Returns
+            the number of cells along an average axis of the grid.
+        """
+        self.data = np.asanyarray(data)
+        bounds, center = get_bounds_and_center(self.data)
+        self.origin = center - bounds * 0.5
+
+        # Determine the voxel edge length. Flat axes are ignored to
+        # not shrink the cells of planar data.
+        extents = bounds[bounds != 0]
+        self.celllen = np.average(extents) \
+            / res_heuristic(data, bounds, center) if len(extents) else 1.
+
+        # Pad the grid by one cell on each side, so that the neighbors
+        # of every occupied cell have a valid key as well
+        cells = self._cells(self.data)
+        self.dims = cells.max(axis=0) + 2
+
+        # Sort data indices by cell and store where each occupied cell
+        # starts and ends in that order
+        keys = self._pack(cells)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, counts = np.unique(
+            keys[self.order],
+            return_index=True,
+            return_counts=True,
+            )
+        self.ends = self.starts + counts
+
+        # If the grid isn't much bigger than the data, also store the
+        # start of every cell, occupied or not, so that cells can be
+        # looked up directly instead of searched for. One more empty
+        # cell is appended to look up invalid keys.
+        cellcnt = np.prod(self.dims)
+        if cellcnt <= 8 * len(self.data) + 2**16:
+            self.cellstarts = np.zeros(cellcnt + 2, dtype=np.int64)
+            self.cellstarts[self.keys + 1] = counts
+            np.cumsum(self.cellstarts, out=self.cellstarts)
+        else:
+            self.cellstarts = None
+
+    def _cells(self, pts):
+        """
+        Return the padded integer cell coordinates of the given points.
+        """
+        return np.floor((pts - self.origin) / self.celllen) \
+            .astype(np.int64) + 1
+
+    def _pack(self, cells):
         """
-        self.data = data
-        bounds, center = get_bounds_and_center(data)
-
-        # Determine the voxel edge length
-        self.celllen = np.average(np.divide(
-            res_heuristic(data, bounds, center),
-            bounds,
-            # Prevent division by zero
-            out=np.zeros_like(bounds, dtype=float),
-            where=bounds != 0,
-            ))
-
-        # Quantize data and bring in a form that can be broadcast by
-        # NumPy. For N vertices, this transforms the array from
-        # (N, 3) to (N, 1, 3) dimensions.
-        qdata = quantize(data, self.celllen)[:, np.newaxis]
-
-        # Generate voxel kernel from all 3**3 = 27 combinations of
-        # -1, 0, and 1.
-        o = np.array((-1, 0, 1)) * self.celllen
-        kern = np.array(np.meshgrid(o, o, o)).T.reshape(-1, 3)
-
-        # Generate array that not only contains every quantized point,
-        # but also the points offset by the voxel cell size along each
-        # axis in +/- direction. For each original data entry, that
-        # yields 3**3 = 27 entries.
-        kdata = (kern + qdata).reshape(-1, 3)
-
-        # Build hash. Every data point gets linked to the cell it's
-        # in as well as all 26 neighboring cells. This overlap is what
-        # guarantees fast "closest vertex" lookup at the cost of higher
-        # memory consumption.
-        self.hash = defaultdict(list)
-        for i, c in enumerate(kdata):
-            # Store index in data array for each of the 27 entries.
-            self.hash[tuple(c)] += [floor(i / 27)]
+        Pack integer cell coordinates into one integer key per cell.
+        """
+        return np.ravel_multi_index(cells.T, self.dims)
+
+    def _gather(self, cells):
+        """
+        Return the data indices in each of the given cells in CSR form,
+        as returned by _expand(). Cells outside of the grid are empty.
+        """
+        cells = np.asarray(cells).reshape(-1, 3)
+        valid = np.all((0 <= cells) & (cells < self.dims), axis=1)
+        keys = np.full(len(cells), -1, dtype=np.int64)
+        keys[valid] = self._pack(cells[valid])
+
+        if self.cellstarts is not None:
+            # Look up each key directly. Invalid keys point to the
+            # empty cell at the end.
+            keys[~valid] = len(self.cellstarts) - 2
+            starts = self.cellstarts[keys]
+            ends = self.cellstarts[keys + 1]
+        else:
+            # Find each key among the occupied cells
+            pos = np.searchsorted(self.keys, keys)
+            pos[pos == len(self.keys)] = 0
+            hit = self.keys[pos] == keys
+            starts = np.where(hit, self.starts[pos], 0)
+            ends = np.where(hit, self.ends[pos], 0)
+
+        indcs, offsets = _expand(starts, ends)
+        return self.order[indcs], offsets
 
     def find_close(self, p):
         """
-        Returns a list of data indices in the vicinity of the given
-        point.
+        Returns an array of data indices in the vicinity of the given
+        point. Every data point closer to it than the cell length is
+        guaranteed to be included.
         """
-        return self.hash(tuple(quantize(p, self.celllen)))
+        cell = self._cells(np.asarray(p).reshape(1, 3))
+        indcs, _ = self._gather(cell + self._kern)
+        return indcs
 
     def find_closest(self, p):
         """
@@ -81,5 +167,7 @@ class SpatialHasher:
         """
         close = self.find_close(p)
         # Search through all data if hash misses
-        vs = close if close else self.data
-        return np.argmin(np.linalg.norm(vs - np.asarray(p)))
+        if not len(close):
+            close = np.arange(len(self.data))
+        dists = np.linalg.norm(self.data[close] - np.asarray(p), axis=1)
+        return close[np.argmin(dists)]
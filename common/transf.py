@@ -103,6 +103,42 @@ def transf_dist(mat, dist):
     return np.asanyarray(mat)[:3, :3] @ dist
 
 
+def get_uniform_scale(mat, tol=1e-5):
+    """
+    Return the scale factor of a transformation matrix that only
+    rotates, mirrors, translates, and scales uniformly, i.e. preserves
+    ratios of distances.
+
+    Parameters
+    ----------
+    mat : Iterable
+        3x3 or 4x4 transformation matrix
+    tol : float = 1e-5
+        Tolerated deviation from a uniform scale, relative to it
+
+    Returns
+    -------
+    scale : float or None
+        Factor all distances are scaled by, None if the matrix also
+        shears or scales non-uniformly
+
+    Examples
+    --------
+    >>> get_uniform_scale(np.diag([2, 2, -2]))
+    2.0
+    >>> get_uniform_scale(np.diag([1, 2, 1])) is None
+    True
+    """
+    m = np.asanyarray(mat, dtype=np.float64)[:3, :3]
+    # m.T @ m is a multiple of the identity exactly for such matrices
+    gram = m.T @ m
+    sqscale = np.trace(gram) / 3
+    if sqscale > 0 and np.allclose(
+            gram, sqscale * np.identity(3), rtol=0, atol=tol * sqscale):
+        return float(np.sqrt(sqscale))
+    return None
+
+
 def complement(a, b):
     """
     Remove all common vectors found in a and b from a.
@@ -0,0 +1,316 @@
+import bpy
+import numpy as np
+
+from mathutils import Matrix
+
+from smorgasbord.common.cache import DescriptorCache
+from smorgasbord.common.io import get_bounds_and_center
+from smorgasbord.common.mat_manip import make_transf_mat, make_proj_mat
+from smorgasbord.common.raster import NO_TRI, rasterize
+from smorgasbord.common.render import (
+    gpu_available,
+    render_depths,
+    render_ids,
+)
+from smorgasbord.common.sample import sample_sphere, sample_hemisphere
+
+
+class ViewTester:
+    """
+    Mixin for operators rendering objects from positions around them
+    to test which of their elements are visible. Holds the options of
+    where and how to render, and caches rendered views.
+    """
+    samplecnt: bpy.props.IntProperty(
+            name="Sample Count",
+            description=(
+                "Number of times the objects are rendered from "
+                "different angles. Lower values decrease calculation "
+                "time, but increase the change that visible elements "
+                "are missed"
+            ),
+            default=16,
+    )
+    dim: bpy.props.IntProperty(
+            name="Resolution",
+            description=(
+                "Pixel count of the rendered images along one axis. "
+                "Lower values decrease calculation time, but increase "
+                "the change that an element is declared occluded when it "
+                "barely peeks out behind an occluder"
+            ),
+            default=128,
+    )
+    dom: bpy.props.EnumProperty(
+            name="Domain",
+            description=(
+                "On which surface to sample the render positions. The "
+                "radius is chosen adaptively from the bounds of the "
+                "objects"
+            ),
+            items=(
+                ('SPHERE', "Sphere", "Also render from the bottom"),
+                ('HEMI', "Hemisphere", "Render only from above"),
+            )
+    )
+    method: bpy.props.EnumProperty(
+            name="Method",
+            description="How to distribute the render positions",
+            items=(
+                ('RANDOM', "Random", "Independent random positions"),
+                ('STRATIFIED', "Stratified",
+                 "Random positions, but spread more evenly"),
+                ('FIBONACCI', "Fibonacci",
+                 "Positions on a spiral lattice, spread most evenly"),
+                ('SEQUENCE', "Sequence",
+                 "Positions from a low-discrepancy sequence, spread "
+                 "evenly however many are taken"),
+            ),
+            default='RANDOM',
+    )
+    seed: bpy.props.IntProperty(
+            name="Seed",
+            description=(
+                "Seed for choosing render positions. The same seed "
+                "yields the same positions on every redo"
+            ),
+            default=0,
+            min=0,
+    )
+    adaptive: bpy.props.BoolProperty(
+            name="Adaptive",
+            description=(
+                "Render from positions of a low-discrepancy sequence "
+                "until new positions hardly reveal anything, but from "
+                "at most Sample Count positions"
+            ),
+            default=False,
+    )
+    patience: bpy.props.IntProperty(
+            name="Patience",
+            description=(
+                "Number of consecutive positions that have to reveal "
+                "too little to stop rendering"
+            ),
+            default=4,
+            min=1,
+    )
+    min_gain: bpy.props.FloatProperty(
+            name="Minimum Gain",
+            description=(
+                "Fraction of all tested elements a position has to "
+                "newly reveal to not count towards stopping"
+            ),
+            default=.001,
+            min=0,
+            max=1,
+            step=.01,
+            precision=4,
+    )
+    backend: bpy.props.EnumProperty(
+            name="Backend",
+            description="Where to render the views",
+            items=(
+                ('AUTO', "Auto",
+                 "On the GPU if there is one, otherwise on the CPU"),
+                ('GPU', "GPU", "On the GPU. Fails without one, as in "
+                 "background mode"),
+                ('CPU', "CPU", "With a software rasterizer on the CPU. "
+                 "Slower, but runs everywhere"),
+            ),
+            default='AUTO',
+    )
+    views_per_pass: bpy.props.IntProperty(
+            name="Views per Pass",
+            description=(
+                "Number of views rendered side by side into one image "
+                "and tested at once. Higher values save round trips "
+                "to the GPU, but need more memory"
+            ),
+            default=4,
+            min=1,
+    )
+    # Results of views rendered before, keyed by geometry, resolution,
+    # what was rendered, and view, so redoing an operator only renders
+    # views it didn't render yet. Bounded by bytes, as a view's size
+    # grows with the square of the resolution.
+    _depths = DescriptorCache(maxsize=64, maxbytes=2**28)
+    # Whether offscreen rendering works, checked on first use
+    _gpu_ok = None
+    _debug_spawn_cams = False
+    _debug_spawn_sphere = False
+
+    def _check_backend(self):
+        """
+        Report an error and return False if the GPU backend is chosen,
+        but there is no GPU.
+        """
+        if self._get_backend() == 'GPU' and not gpu_available():
+            self.report({'ERROR'}, "No GPU available, use the CPU backend")
+            return False
+        return True
+
+    def _get_backend(self):
+        """
+        Return 'GPU' or 'CPU', resolving 'AUTO' to whether a GPU is
+        available.
+        """
+        if self.backend != 'AUTO':
+            return self.backend
+        cls = type(self)
+        if cls._gpu_ok is None:
+            cls._gpu_ok = gpu_available()
+        return 'GPU' if cls._gpu_ok else 'CPU'
+
+    def _make_views(self, verts):
+        """
+        Sample render positions around the given vertices and return
+        the Model View Projection matrix of each.
+        """
+        dim = self.dim
+        sample = sample_sphere if self.dom == 'SPHERE' \
+            else sample_hemisphere
+
+        # Find the center and bounds of all objects to calculate the
+        # encompassing radius of the (hemi-)sphere on which render
+        # positions will be sampled
+        bounds, centr = get_bounds_and_center(verts)
+        rad = np.linalg.norm(bounds[:2]) * .5 + 1
+        del bounds
+
+        # Spawn debug sphere with calculated radius
+        if self._debug_spawn_sphere:
+            bpy.ops.mesh.primitive_uv_sphere_add(
+                radius=rad,
+                location=centr,
+                )
+
+        # Generate points on the chosen domain from which to render the
+        # objects. Adaptive mode needs points that are evenly spread
+        # however many of them end up being used.
+        samplepos, (thetas, phis) = sample(
+            rad,
+            self.samplecnt,
+            'SEQUENCE' if self.adaptive else self.method,
+            self.seed,
+            )
+
+        mvps = []
+        for pos, theta, phi in zip(samplepos, thetas, phis):
+            # Chose rotation so the 'camera' looks to the center
+            view_mat_inv = make_transf_mat(
+                transl=pos + centr,
+                rot=(phi, 0, theta + np.pi * .5),
+                )
+
+            # Spawn debug camera at sampled position
+            if self._debug_spawn_cams:
+                bpy.ops.object.camera_add()
+                bpy.context.object.matrix_world = Matrix(view_mat_inv)
+
+            # Build the Model View Projection matrix from chosen
+            # render position and radius
+            # The model matrix has already been applied to the vertices
+            # befor creating the batch
+            mvps.append(make_proj_mat(
+                fov=90,
+                clip_start=rad * .25,
+                clip_end=rad * 1.5,
+                dimx=dim,
+                dimy=dim,
+                ) @ np.linalg.inv(view_mat_inv))
+        del samplepos, thetas, phis
+        return mvps
+
+    def _render_views(self, verts, indcs, mvps, backend):
+        """
+        Render the given triangles once per Model View Projection
+        matrix and return the depth buffers, mapped to [-1, 1].
+        """
+        if backend == 'GPU':
+            depths = render_depths(
+                verts, indcs, mvps, self.dim, self.views_per_pass)
+        else:
+            depths = [rasterize(verts, indcs, mvp, self.dim)[0]
+                      for mvp in mvps]
+        # Map depth values from [0, 1] to [-1, 1]
+        return [d * 2 - 1 for d in depths]
+
+    def _render_seen(self, verts, indcs, mvps, backend, vertids=None):
+        """
+        Render the index of the closest triangle per pixel once per
+        Model View Projection matrix and return the sorted indices of
+        the triangles seen in each view. If given, return the seen IDs
+        in 'vertids' instead, which holds one per vertex, the same for
+        all corners of a triangle.
+        """
+        if backend == 'GPU':
+            ids = render_ids(
+                verts, indcs, mvps, self.dim, self.views_per_pass,
+                vertids)
+        else:
+            ids = (rasterize(verts, indcs, mvp, self.dim)[1]
+                   for mvp in mvps)
+        seen = []
+        for i in ids:
+            # One pass over the pixels, however many vertices there are
+            i = np.unique(i)
+            i = i[i != NO_TRI]
+            if vertids is not None and backend != 'GPU':
+                i = np.unique(vertids[indcs[i, 0]])
+            seen.append(i)
+        return seen
+
+    def _test_views(self, keys, mvps, render, test, visibl):
+        """
+        Mark the elements seen from each view, rendering only views
+        not rendered before. Views are rendered and tested
+        'views_per_pass' at a time. In adaptive mode, stop once
+        'patience' consecutive views each reveal less than 'min_gain'
+        of all elements.
+
+        Parameters
+        ----------
+        keys : list
+            Cache key of every view
+        mvps : list
+            Model View Projection matrix of every view
+        render : Callable
+            Renders a list of matrices and returns one result each
+        test : Callable
+            Given the matrices and results of several views, returns
+            the elements each view sees, as mask of or indices into
+            'visibl'
+        visibl : numpy.ndarray
+            Flag of every element, set if it is seen
+
+        Returns
+        -------
+        viewcnt : int
+            Number of views tested
+        """
+        step = self.views_per_pass
+        mingain = self.min_gain * len(visibl)
+        seencnt = 0
+        # Consecutive views that revealed too little
+        calmcnt = 0
+        for start in range(0, len(mvps), step):
+            stop = min(start + step, len(mvps))
+            results = [self._depths.get(k) for k in keys[start:stop]]
+            missing = [i for i, r in enumerate(results) if r is None]
+            if missing:
+                rendered = render([mvps[start + i] for i in missing])
+                for i, r in zip(missing, rendered):
+                    self._depths.put(keys[start + i], r)
+                    results[i] = r
+
+            for i, seen in enumerate(test(mvps[start:stop], results), start):
+                visibl[seen] = True
+                if not self.adaptive:
+                    continue
+                cnt = np.count_nonzero(visibl)
+                calmcnt = calmcnt + 1 if cnt - seencnt < mingain else 0
+                seencnt = cnt
+                if calmcnt >= self.patience:
+                    return i + 1
+        return len(mvps)
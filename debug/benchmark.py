@@ -0,0 +1,481 @@
+"""
+Benchmarks for the array-based routines in smorgasbord.common.
+
+Benchmarks only depending on NumPy run from a plain Python shell, e.g.
+    python -m smorgasbord.debug.benchmark spatial_hasher
+the rest has to be run from inside Blender.
+"""
+from collections import defaultdict
+from math import floor
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def measure(func, *args, **kwargs):
+    """
+    Call a function once and measure its run time and peak memory.
+
+    Returns
+    -------
+    ret : Any
+        Return value of the call
+    secs : float
+        Wall-clock seconds the call took
+    peak : int
+        Peak number of bytes allocated during the call, as traced by
+        tracemalloc. This includes NumPy's buffers.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        ret = func(*args, **kwargs)
+        secs = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return ret, secs, peak
+
+
+def _print_row(*cols):
+    print(''.join(f"{c:>16}" for c in cols))
+
+
+def _legacy_spatial_hash(data):
+    """
+    Build the dict-based hash of the former SpatialHasher, which links
+    every point to the 27 cells around it.
+    """
+    celllen = 3 * len(data) ** 0.33333333 / np.ptp(data, axis=0).mean()
+    qdata = (celllen * np.round(data / celllen))[:, np.newaxis]
+    o = np.array((-1, 0, 1)) * celllen
+    kern = np.array(np.meshgrid(o, o, o)).T.reshape(-1, 3)
+    kdata = (kern + qdata).reshape(-1, 3)
+    hsh = defaultdict(list)
+    for i, c in enumerate(kdata):
+        hsh[tuple(c)] += [floor(i / 27)]
+    return hsh
+
+
+def bench_spatial_hasher(sizes=(10**4, 10**5, 10**6, 10**7), legacymax=10**5):
+    """
+    Compare build time and peak memory of SpatialHasher with the former
+    dict-based implementation. The latter is only run up to 'legacymax'
+    points, as it grows unbearably slow beyond.
+    """
+    from smorgasbord.common.spatial_hasher import SpatialHasher
+
+    _print_row("points", "impl", "build [s]", "peak [MiB]")
+    for n in sizes:
+        data = np.random.default_rng(0).random((n, 3))
+        _, secs, peak = measure(SpatialHasher, data)
+        _print_row(n, "csr", f"{secs:.3f}", f"{peak / 2**20:.1f}")
+        if n <= legacymax:
+            _, secs, peak = measure(_legacy_spatial_hash, data)
+            _print_row(n, "dict", f"{secs:.3f}", f"{peak / 2**20:.1f}")
+
+
+def _mathutils_kdtree(data):
+    """
+    Build a mathutils KDTree point by point, as MaterialTransfer used to
+    do.
+    """
+    from mathutils.kdtree import KDTree
+
+    kd = KDTree(len(data))
+    # Lists are the fastest input for the insertion loop
+    for i, v in enumerate(data.tolist()):
+        kd.insert(v, i)
+    kd.balance()
+    return kd
+
+
+def _mathutils_query(kd, pts):
+    """
+    Query a mathutils KDTree once per point, as MaterialTransfer used to
+    do.
+    """
+    return [kd.find(p)[1] for p in pts.tolist()]
+
+
+def _timed(func, *args):
+    """
+    Return the seconds a call takes. Unlike measure(), it doesn't trace
+    allocations, which slows down code creating many Python objects.
+    """
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_kdtree(sizes=(10**3, 10**4, 10**5, 10**6)):
+    """
+    Compare building and querying BatchKDTree with the same number of
+    points and queries against mathutils' KDTree. The latter is skipped
+    if mathutils isn't available, i.e. outside of Blender.
+
+    Points are either spread through a cube, or lie on a wavy surface
+    like polygon centers do, with queries scattered around it. Times
+    come from other runs than the peak memory.
+    """
+    from smorgasbord.common.kdtree import BatchKDTree
+
+    impls = {"batch": (BatchKDTree, BatchKDTree.query)}
+    try:
+        import mathutils.kdtree  # noqa: F401
+        impls["mathutils"] = (_mathutils_kdtree, _mathutils_query)
+    except ImportError:
+        pass
+
+    rng = np.random.default_rng(0)
+    _print_row("points", "distribution", "impl", "build [s]", "query [s]",
+               "peak [MiB]")
+    for n in sizes:
+        for distrib in ("volume", "surface"):
+            if distrib == "volume":
+                data = rng.random((n, 3))
+                pts = rng.random((n, 3))
+            else:
+                uvs = rng.random((n, 2))
+                data = np.column_stack(
+                    (uvs, .01 * np.sin(20 * uvs[:, 0])))
+                pts = data + rng.normal(scale=.002, size=data.shape)
+
+            for name, (build, query) in impls.items():
+                tree, _, peak = measure(build, data)
+                _, _, qpeak = measure(query, tree, pts)
+                _print_row(
+                    n, distrib, name,
+                    f"{_timed(build, data):.3f}",
+                    f"{_timed(query, tree, pts):.3f}",
+                    f"{max(peak, qpeak) / 2**20:.1f}",
+                    )
+
+
+def _transfer_per_source(sources, pts):
+    """
+    Find the closest point over several sources by building and
+    querying one tree per source, as running MaterialTransfer once per
+    source does.
+    """
+    from smorgasbord.common.kdtree import BatchKDTree
+
+    indcs = np.full(len(pts), -1)
+    dists = np.full(len(pts), np.inf)
+    offset = 0
+    for src in sources:
+        i, d = BatchKDTree(src).query(pts)
+        closer = d < dists
+        indcs[closer] = i[closer] + offset
+        dists[closer] = d[closer]
+        offset += len(src)
+    return indcs, dists
+
+
+def _transfer_combined(sources, pts):
+    """
+    Find the closest point over several sources with one tree over all
+    of them, as MaterialTransfer does for a source collection.
+    """
+    from smorgasbord.common.kdtree import BatchKDTree
+
+    return BatchKDTree(np.concatenate(sources)).query(pts)
+
+
+def bench_multi_source(counts=(1, 4, 16), srcsize=2 * 10**4,
+                       querycnt=2 * 10**5):
+    """
+    Compare transferring from several sources in one pass against one
+    pass per source. Sources are clusters of face centers spread along
+    a line, like the parts of an assembly.
+    """
+    rng = np.random.default_rng(0)
+    _print_row("sources", "impl", "time [s]", "peak [MiB]")
+    for cnt in counts:
+        sources = [rng.random((srcsize, 3)) + (i, 0, 0) for i in range(cnt)]
+        pts = rng.random((querycnt, 3)) * (cnt, 1, 1)
+        for name, func in (
+                ("combined", _transfer_combined),
+                ("per source", _transfer_per_source),
+                ):
+            _, secs, peak = measure(func, sources, pts)
+            _print_row(cnt, name, f"{secs:.3f}", f"{peak / 2**20:.1f}")
+
+
+def bench_overlap(sizes=(10**4, 10**5, 10**6), dist=.002):
+    """
+    Measure the overlap test of SelectOverlap between two point clouds
+    of the same size, with one KD-tree query bounded by the radius.
+    """
+    from smorgasbord.common.kdtree import BatchKDTree
+
+    rng = np.random.default_rng(0)
+    _print_row("vertices", "time [s]", "peak [MiB]", "overlapping")
+
+    def overlap(active, other):
+        hits, _ = BatchKDTree(other).query(active, dist)
+        return hits >= 0
+
+    for n in sizes:
+        sel, secs, peak = measure(
+            overlap, rng.random((n, 3)), rng.random((n, 3)) + (.5, 0, 0))
+        _print_row(n, f"{secs:.3f}", f"{peak / 2**20:.1f}",
+                   np.count_nonzero(sel))
+
+
+def _legacy_sample_mesh(mesh, samplecnt):
+    """
+    Sample a mesh the way sample_mesh() used to: triangulate a bmesh
+    copy and write it to a temporary mesh to read triangle areas.
+    """
+    import bmesh as bm
+    import bpy
+
+    from smorgasbord.common.io import get_scalars, get_vecs
+    from smorgasbord.common.sample import sample_tris
+
+    bob = bm.new()
+    bob.from_mesh(mesh, face_normals=False)
+    bm.ops.triangulate(bob, faces=bob.faces)
+    tmp = bpy.data.meshes.new("tmp")
+    bob.to_mesh(tmp)
+    bob.free()
+    get_scalars(tmp.polygons, 'area', np.float64)
+    pts = get_vecs(tmp.vertices)
+    tris = get_vecs(tmp.polygons, 'vertices', dtype=np.int32)
+    bpy.data.meshes.remove(tmp)
+    return sample_tris(pts, tris, samplecnt)
+
+
+def bench_sample_mesh(subdivs=(3, 5, 7), samplecnt=1024):
+    """
+    Compare sampling a mesh via its loop triangles against the former
+    bmesh round-trip. Needs to run inside Blender.
+    """
+    import bmesh as bm
+    import bpy
+
+    from smorgasbord.common.sample import sample_mesh
+
+    _print_row("faces", "impl", "time [s]", "peak [MiB]")
+    for subdiv in subdivs:
+        bob = bm.new()
+        bm.ops.create_icosphere(bob, subdivisions=subdiv, radius=1)
+        mesh = bpy.data.meshes.new("bench")
+        bob.to_mesh(mesh)
+        bob.free()
+        for name, func in (
+                ("loop_triangles", sample_mesh),
+                ("bmesh", _legacy_sample_mesh),
+                ):
+            _, secs, peak = measure(func, mesh, samplecnt)
+            _print_row(len(mesh.polygons), name, f"{secs:.3f}",
+                       f"{peak / 2**20:.1f}")
+        bpy.data.meshes.remove(mesh)
+
+
+def _legacy_shape_distrib(points, bincnt):
+    """
+    Calculate the shape distribution the way get_shape_distrib() used
+    to, holding all pairs in memory at once.
+    """
+    i, j = np.triu_indices(len(points), k=1)
+    return np.histogram(
+        np.linalg.norm(points[i] - points[j], axis=1),
+        bins=bincnt,
+        )
+
+
+def bench_shape_distrib(sizes=(512, 2048, 8192, 16392), legacymax=4096,
+                        maxpairs=2**20):
+    """
+    Compare time and peak memory of the exact, chunked shape
+    distribution with the random-pair estimate and the former
+    implementation. The latter is only run up to 'legacymax' samples,
+    as its memory grows with the square of the sample count.
+    """
+    from smorgasbord.common.sample import get_shape_distrib
+
+    rng = np.random.default_rng(0)
+    _print_row("samples", "impl", "time [s]", "peak [MiB]")
+    for n in sizes:
+        pts = rng.random((n, 3))
+        bincnt = int(np.ceil(np.sqrt(n)))
+        for name, func, args in (
+                ("chunked", get_shape_distrib, (pts, bincnt)),
+                (f"{maxpairs} pairs", get_shape_distrib,
+                 (pts, bincnt, maxpairs, 0)),
+                ("legacy", _legacy_shape_distrib, (pts, bincnt)),
+                ):
+            if name == "legacy" and n > legacymax:
+                continue
+            _, secs, peak = measure(func, *args)
+            _print_row(n, name, f"{secs:.3f}", f"{peak / 2**20:.1f}")
+
+
+def _wavy_grid(k):
+    """
+    Return vertices and triangles of a k x k grid bent into waves.
+    """
+    x, y = np.meshgrid(np.linspace(0, 1, k), np.linspace(0, 1, k))
+    verts = np.column_stack((
+        x.ravel(),
+        y.ravel(),
+        .1 * np.sin(6 * x.ravel()) * np.cos(5 * y.ravel()),
+        ))
+    i = np.arange(k * k).reshape(k, k)[:-1, :-1].ravel()
+    tris = np.concatenate((
+        np.column_stack((i, i + 1, i + k)),
+        np.column_stack((i + 1, i + k + 1, i + k)),
+        ))
+    return verts, tris
+
+
+def bench_bvh(sizes=(100, 300, 1000), querycnt=10**5, noise=.005):
+    """
+    Measure building a TriangleBVH over a wavy grid and projecting
+    points scattered closely around its surface onto it.
+    """
+    from smorgasbord.common.bvh import TriangleBVH
+
+    rng = np.random.default_rng(0)
+    _print_row("triangles", "build [s]", "query [s]", "peak [MiB]")
+    for k in sizes:
+        verts, tris = _wavy_grid(k)
+        pts = verts[rng.integers(0, len(verts), querycnt)] \
+            + rng.normal(0, noise, (querycnt, 3))
+        tree, build, peak = measure(TriangleBVH, verts, tris)
+        _, query, qpeak = measure(tree.find_closest, pts)
+        _print_row(len(tris), f"{build:.3f}", f"{query:.3f}",
+                   f"{max(peak, qpeak) / 2**20:.1f}")
+
+
+def bench_readback(sizes=(128, 256, 512, 1024, 2048), reps=8):
+    """
+    Compare the per-view cost of reading back a depth buffer via a
+    Python list with reading it into a reused buffer. Needs to run
+    inside Blender with a GPU context.
+    """
+    import gpu
+
+    from smorgasbord.common.render import DepthReader
+
+    def via_list(framebuffer, dim):
+        pxbuf = framebuffer.read_depth(0, 0, dim, dim)
+        return np.array(pxbuf.to_list()).reshape(dim, dim)
+
+    _print_row("pixels", "impl", "time [ms]", "peak [MiB]")
+    for dim in sizes:
+        offbuf = gpu.types.GPUOffScreen(dim, dim)
+        read_depth = DepthReader(dim)
+        with offbuf.bind():
+            framebuffer = gpu.state.active_framebuffer_get()
+            framebuffer.clear(depth=1.0)
+            for name, func, args in (
+                    ("to_list", via_list, (framebuffer, dim)),
+                    ("buffer", read_depth, (framebuffer,)),
+                    ):
+                secs = peak = 0
+                for _ in range(reps):
+                    _, s, p = measure(func, *args)
+                    secs += s
+                    peak = max(peak, p)
+                _print_row(f"{dim}x{dim}", name,
+                           f"{secs / reps * 1e3:.2f}",
+                           f"{peak / 2**20:.1f}")
+        offbuf.free()
+
+
+def bench_raster(sizes=(128, 256, 512, 1024), k=300, viewcnt=4):
+    """
+    Compare the per-view time of rendering depth on the GPU with the
+    software rasterizer, for a wavy grid of about 2 * 'k'^2 triangles
+    seen from above. The GPU is only measured inside Blender.
+    """
+    from smorgasbord.common.mat_manip import make_proj_mat, make_transf_mat
+    from smorgasbord.common.raster import rasterize
+    try:
+        from smorgasbord.common.render import gpu_available, render_depths
+        has_gpu = gpu_available()
+    except ImportError:
+        has_gpu = False
+
+    verts, tris = _wavy_grid(k)
+    verts = verts.astype(np.float32)
+    tris = tris.astype(np.int32)
+    mvps = [
+        make_proj_mat(fov=90, clip_start=.1, clip_end=4, dimx=1, dimy=1)
+        @ np.linalg.inv(make_transf_mat(
+            transl=(.5 + .1 * i, .5, 1), rot=(.1 * i, 0, 0)))
+        for i in range(viewcnt)
+        ]
+
+    def on_cpu(dim):
+        return [rasterize(verts, tris, mvp, dim) for mvp in mvps]
+
+    impls = [("CPU", on_cpu)]
+    if has_gpu:
+        impls.insert(0, ("GPU", lambda dim: render_depths(
+            verts, tris, mvps, dim)))
+
+    _print_row("pixels", "backend", "time [ms]", "peak [MiB]")
+    for dim in sizes:
+        for name, func in impls:
+            _, secs, peak = measure(func, dim)
+            _print_row(f"{dim}x{dim}", name,
+                       f"{secs / viewcnt * 1e3:.1f}",
+                       f"{peak / 2**20:.1f}")
+
+
+def bench_views_per_pass(perpasses=(1, 2, 4, 8, 16), dim=256, k=300,
+                         viewcnt=16):
+    """
+    Measure the per-view time of rendering depth on the GPU with
+    several views rendered into one atlas and read back at once. Needs
+    to run inside Blender with a GPU context.
+    """
+    from smorgasbord.common.mat_manip import make_proj_mat, make_transf_mat
+    from smorgasbord.common.render import render_depths
+
+    verts, tris = _wavy_grid(k)
+    verts = verts.astype(np.float32)
+    tris = tris.astype(np.int32)
+    mvps = [
+        make_proj_mat(fov=90, clip_start=.1, clip_end=4, dimx=1, dimy=1)
+        @ np.linalg.inv(make_transf_mat(
+            transl=(.5, .5, 1), rot=(.05 * i, 0, 0)))
+        for i in range(viewcnt)
+        ]
+
+    _print_row("views per pass", "time [ms]", "peak [MiB]")
+    for perpass in perpasses:
+        _, secs, peak = measure(render_depths, verts, tris, mvps, dim,
+                                perpass)
+        _print_row(perpass, f"{secs / viewcnt * 1e3:.1f}",
+                   f"{peak / 2**20:.1f}")
+
+
+benchmarks = {
+    'spatial_hasher': bench_spatial_hasher,
+    'kdtree': bench_kdtree,
+    'bvh': bench_bvh,
+    'multi_source': bench_multi_source,
+    'overlap': bench_overlap,
+    'sample_mesh': bench_sample_mesh,
+    'shape_distrib': bench_shape_distrib,
+    'readback': bench_readback,
+    'raster': bench_raster,
+    'views_per_pass': bench_views_per_pass,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        print(name)
+        try:
+            benchmarks[name]()
+        except ImportError as e:
+            # Benchmarks of Blender API paths only run inside Blender
+            print(f"skipped: {e}")
@@ -24,6 +24,7 @@ for m in [
     ".select_flipped_faces",
     ".select_overlap",
     ".select_visible",
+    ".select_occluded",
     ".select_loose_by_size",
     ".select_n_instances",
     ".select_similar",
@@ -1,23 +1,100 @@
 import bpy
-from mathutils.kdtree import KDTree
 import numpy as np
 
+from smorgasbord.common.bvh import TriangleBVH
 from smorgasbord.common.decorate import register
 from smorgasbord.common.io import get_vecs, get_scalars, set_vals
+from smorgasbord.common.kdtree import BatchKDTree
 from smorgasbord.common.transf import transf_pts
 
 
+def _get_source(ob, mode, in_wrld_crds):
+    """
+    Return the geometry of a source object to build a search tree from.
+
+    Parameters
+    ----------
+    ob : bpy.types.Object
+        Source object with mesh data
+    mode : str
+        'CENTER' to return polygon centers, 'SURFACE' for triangles
+    in_wrld_crds : bool
+        Whether to return coordinates in world space
+
+    Returns
+    -------
+    pts : numpy.ndarray
+        Nx3 array of polygon centers or vertex coordinates
+    tris : numpy.ndarray or None
+        Mx3 array of vertex indices of each loop triangle in 'SURFACE'
+        mode, else None
+    polys : numpy.ndarray
+        Polygon index of each center or triangle
+    """
+    data = ob.data
+    if mode == 'SURFACE':
+        data.calc_loop_triangles()
+        pts = get_vecs(data.vertices)
+        tris = get_vecs(data.loop_triangles, 'vertices', 3, np.int32)
+        polys = get_scalars(data.loop_triangles, 'polygon_index', np.int32)
+    else:
+        pts = get_vecs(data.polygons, 'center')
+        tris = None
+        polys = np.arange(len(data.polygons))
+
+    if in_wrld_crds:
+        pts = transf_pts(np.array(ob.matrix_world), pts)
+    return pts, tris, polys
+
+
 @register
 class MaterialTransfer(bpy.types.Operator):
     bl_idname = "object.material_transfer"
     bl_label = "Transfer Materials"
     bl_description = (
         "For each polygon in the active object, transfer its material "
-        "index to the closest polygon in each selected object"
+        "index to the closest polygon in each selected object. With "
+        "several sources, the closest polygon of any source is used"
     )
     bl_options = {'REGISTER', 'UNDO'}
     menus = [bpy.types.VIEW3D_MT_object_relations]
 
+    source: bpy.props.EnumProperty(
+        name="Source",
+        description="Which objects to transfer materials from",
+        items=(
+            ('ACTIVE', "Active", "Transfer from the active object to "
+             "all other selected objects"),
+            ('COLLECTION', "Collection", "Transfer from all selected "
+             "objects in the active object's collection to all other "
+             "selected objects"),
+        ),
+        default='ACTIVE',
+    )
+
+    mode: bpy.props.EnumProperty(
+        name="Mode",
+        description="How the closest source polygon is determined",
+        items=(
+            ('CENTER', "Face Center", "Match polygon centers. Fast, "
+             "but inaccurate on long and thin polygons"),
+            ('SURFACE', "Surface", "Project polygon centers onto the "
+             "closest point of the source surface"),
+        ),
+        default='CENTER',
+    )
+
+    max_dist: bpy.props.FloatProperty(
+        name="Max Distance",
+        description=(
+            "Polygons farther away from any source polygon keep their "
+            "material. Zero disables the limit"
+        ),
+        subtype='DISTANCE',
+        default=0,
+        min=0,
+    )
+
     in_wrld_crds: bpy.props.BoolProperty(
         name="In world coordinates",
         description="Find nearest geometry in global, not in local space",
@@ -41,39 +118,85 @@ class MaterialTransfer(bpy.types.Operator):
              and len(context.selected_objects) > 1
         )
 
+    def _build_index(self, sources):
+        """
+        Build one search tree over the polygons of all sources.
+
+        Returns
+        -------
+        tree : BatchKDTree
+            Search tree over the polygons of all sources
+        lmats : numpy.ndarray
+            Material index of every primitive's polygon in its source
+        gmats : numpy.ndarray
+            Material index of every primitive's polygon in 'mats', -1
+            for sources without material slots
+        mats : list[bpy.types.Material]
+            Material slots of all sources, without duplicates
+        """
+        pts = []
+        tris = []
+        lmats = []
+        gmats = []
+        mats = []
+        vertcnt = 0
+        for ob in sources:
+            spts, stris, spolys = _get_source(
+                ob, self.mode, self.in_wrld_crds)
+            if stris is not None:
+                # Offset indices by the vertices of previous sources
+                tris.append(stris + vertcnt)
+                vertcnt += len(spts)
+            pts.append(spts)
+
+            # Map the source's material slots to the combined slots
+            slotmap = np.empty(len(ob.data.materials), dtype=np.int32)
+            for j, m in enumerate(ob.data.materials):
+                if m not in mats:
+                    mats.append(m)
+                slotmap[j] = mats.index(m)
+
+            smats = get_scalars(
+                ob.data.polygons, 'material_index', np.int32)[spolys]
+            lmats.append(smats)
+            # Indices past the last slot use the last slot. Without
+            # slots, there is no material to transfer.
+            gmats.append(
+                slotmap[np.minimum(smats, len(slotmap) - 1)]
+                if len(slotmap) else np.full_like(smats, -1)
+                )
+
+        pts = np.concatenate(pts)
+        if tris:
+            tree = TriangleBVH(pts, np.concatenate(tris))
+        else:
+            tree = BatchKDTree(pts)
+        return tree, np.concatenate(lmats), np.concatenate(gmats), mats
+
     def execute(self, context):
-        source = context.object
-        try:
-            sdata = source.data
-            sgeom = sdata.polygons
-        except AttributeError:
+        sources = [context.object]
+        if self.source == 'COLLECTION':
+            colobs = context.object.users_collection[0].objects
+            sources += [o for o in context.selected_objects
+                        if o.name in colobs and o is not context.object]
+        targets = [o for o in context.selected_objects
+                   if o not in sources]
+        sources = [o for o in sources if isinstance(o.data, bpy.types.Mesh)]
+
+        if not sources:
             self.report(
                 {'ERROR_INVALID_INPUT'},
-                "The active object needs to have a mesh data block.",
+                "No source object has a mesh data block.",
             )
             return {'CANCELLED'}
 
-        # get comparison values for source
-        scvals = get_vecs(sgeom, 'center')
-        if self.in_wrld_crds:
-            # transform source to world coordinates
-            mat = np.array(source.matrix_world)
-            scvals = transf_pts(mat, scvals)
-
-        # build KD-Tree from comparison values
-        kd = KDTree(len(sgeom))
-        for i, v in enumerate(scvals):
-            kd.insert(v, i)
-        kd.balance()
-
-        # get values to transfer from source
-        stvals = get_scalars(sgeom, 'material_index', np.int8)
+        # build one search tree over the comparison values of all
+        # sources
+        tree, lmats, gmats, mats = self._build_index(sources)
+        maxdist = self.max_dist or np.inf
 
         all_meshless = True  # for error-reporting
-        for target in context.selected_objects:
-            if target is source:
-                continue
-
+        for target in targets:
             try:
                 tdata = target.data
                 tgeom = tdata.polygons
@@ -88,13 +211,16 @@ class MaterialTransfer(bpy.types.Operator):
                 # transform target to world coordinates
                 mat = np.array(target.matrix_world)
                 tcvals = transf_pts(mat, tcvals)
-                ttvals = np.empty(len(tgeom), dtype=np.int32)
 
             # for every comparison point in target, find closest in
             # source and copy over its transfer value
-            for ti, tv in enumerate(tcvals):
-                _, si, _ = kd.find(tv)
-                ttvals[ti] = stvals[si]
+            hits, _ = tree.query(tcvals, maxdist)
+            found = hits >= 0
+            stvals = (gmats if self.assign_mat else lmats)[hits[found]]
+            # Polygons closest to a source without slots keep theirs
+            found[found] = stvals >= 0
+            ttvals = get_scalars(tgeom, 'material_index', np.int32)
+            ttvals[found] = stvals[stvals >= 0]
 
             # set values to transfer to target
             set_vals(tgeom, ttvals, 'material_index')
@@ -102,7 +228,7 @@ class MaterialTransfer(bpy.types.Operator):
             tmats = tdata.materials
             if self.assign_mat:
                 # transfer assigned materials
-                for i, m in enumerate(sdata.materials):
+                for i, m in enumerate(mats):
                     if i < len(tmats):
                         tmats[i] = m
                     else:
@@ -4,7 +4,7 @@ from math import pi
 import numpy as np
 
 from smorgasbord.common.io import (
-    get_bounds_and_center,
+    get_part_bounds_and_centers,
     get_scalars,
     get_vecs,
 )
@@ -148,12 +148,25 @@ class SelectConcaveParts(bpy.types.Operator):
 
             del flags
             # second representation of patches, this time as a tuple of
-            # face indices, max angle, and diameter
-            patches2 = []
-
-            for findcs, maxangl in patches:
-                bounds, _ = get_bounds_and_center(centrs[findcs])
-                patches2.append((findcs, maxangl, np.linalg.norm(bounds)))
+            # face indices, max angle, and diameter. The diameters of
+            # all patches are calculated at once from their
+            # concatenated face indices.
+            if patches:
+                findcs = np.concatenate([f for f, _ in patches])
+                labels = np.repeat(
+                    np.arange(len(patches)),
+                    [len(f) for f, _ in patches],
+                    )
+                _, _, bounds, _ = get_part_bounds_and_centers(
+                    centrs[findcs], labels)
+                diams = np.linalg.norm(bounds, axis=1)
+            else:
+                diams = ()
+
+            patches2 = [
+                (findcs, maxangl, diam)
+                for (findcs, maxangl), diam in zip(patches, diams)
+                ]
             self._meshes.append((data, patches2))
 
     def execute(self, context):
@@ -1,15 +1,12 @@
-import bmesh
 import bpy
 import numpy as np
-from operator import concat
 
 from smorgasbord.common.decorate import register
 from smorgasbord.common.io import (
-    get_parts,
+    get_part_bounds_and_centers,
     get_vecs,
-    get_bounds_and_center,
+    label_parts,
 )
-from smorgasbord.thirdparty.redblack.redblack import TreeDict
 
 
 @register
@@ -71,15 +68,13 @@ class SelectLooseBySize(bpy.types.Operator):
         set=_set_method,
     )
 
-    # Loose parts data to store between executions. List of tuples.
-    # First tuple entry is the reference to a mesh's vertex collection,
-    # second the mesh's list of loose parts, which in turn is a TreeDict
-    # with the vertex indices as values and the compare method's result
-    # for those indices as key.
+    # Loose parts data to store between executions. List of tuples,
+    # one per mesh. First tuple entry is the reference to the mesh's
+    # vertex collection. Second is the sorted array of each part's
+    # compare method result. Third and fourth form a CSR-style list of
+    # the parts in that same order: the vertex indices of the i-th part
+    # are indcs[offsets[i]:offsets[i + 1]].
     _data = []
-    # Number of digits the compare method's result is rounded to in
-    # order to improve binning performance in the TreeDict.
-    _resolution = 5
 
     @classmethod
     def poll(cls, context):
@@ -87,27 +82,31 @@ class SelectLooseBySize(bpy.types.Operator):
 
     def _find_parts(self, obs):
         for o in obs:
-            # get parts, each a vertex index list
-            bob = bmesh.new()
-            bob.from_mesh(o.data)
-            parts = get_parts(bob.verts)
-            del bob
+            # label every vertex with the part it belongs to
+            data = o.data
+            edges = get_vecs(data.edges, 'vertices', 2, np.int32)
+            labels, _, _ = label_parts(edges, len(data.vertices))
 
             # choose comparison method
             method = np.linalg.norm if self._method == 0 else np.prod
 
-            # create dict of parts and their comparison value
-            partdict = TreeDict(acc=concat)
-            coords = get_vecs(o.data.vertices)
-            for indcs in parts:
-                bounds, _ = get_bounds_and_center(coords[indcs])
-                # calculate comparison value from bounding box,
-                # round to create less bins in dict for better
-                # performance
-                key = round(method(bounds), self._resolution)
-                partdict[key] = indcs
+            # calculate comparison value from bounding box of every
+            # part
+            coords = get_vecs(data.vertices)
+            _, _, bounds, _ = get_part_bounds_and_centers(coords, labels)
+            keys = method(bounds, axis=1)
 
-            self._data.append((o.data.vertices, partdict))
+            # sort parts by their comparison value and reorder the
+            # vertex indices accordingly, so that the parts in any
+            # value range are one contiguous slice
+            order = np.argsort(keys, kind='stable')
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            indcs = np.argsort(rank[labels], kind='stable')
+            offsets = np.zeros(len(order) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(labels)[order], out=offsets[1:])
+
+            self._data.append((data.vertices, keys[order], offsets, indcs))
 
     def invoke(self, context, event):
         # Without invoke(), executing this operation several times
@@ -129,13 +128,13 @@ class SelectLooseBySize(bpy.types.Operator):
 
         minv, maxv = self._vol_limits
         try:
-            for verts, parts in self._data:
+            for verts, keys, offsets, indcs in self._data:
                 # bool array of vertex indices storing whether
                 # the vert at that index needs to get selected
                 sel_flags = np.zeros(len(verts), dtype=bool)
                 # set flag for every vertex in a part with right volume
-                for node in parts[minv:maxv]:
-                    sel_flags[node.val] = True
+                start, end = offsets[np.searchsorted(keys, (minv, maxv))]
+                sel_flags[indcs[start:end]] = True
 
                 verts.foreach_set('select', sel_flags)
         finally:
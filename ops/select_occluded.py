@@ -0,0 +1,107 @@
+import bpy
+import numpy as np
+from time import perf_counter
+
+from smorgasbord.common.cache import make_key
+from smorgasbord.common.decorate import register
+from smorgasbord.common.mesh_manip import combine_meshes
+from smorgasbord.common.visibility import ViewTester
+
+
+@register
+class SelectOccluded(ViewTester, bpy.types.Operator):
+    bl_idname = "object.select_occluded"
+    bl_label = "Select Occluded"
+    bl_description = (
+        "Renders selected mesh objects from random positions around "
+        "them and selects the ones not seen from any position, or "
+        "deletes them"
+    )
+    bl_options = {'REGISTER', 'UNDO'}
+    menus = [bpy.types.VIEW3D_MT_select_object]
+
+    action: bpy.props.EnumProperty(
+            name="Action",
+            description="What to do with occluded objects",
+            items=(
+                ('SELECT', "Select",
+                 "Select occluded objects, deselecting the others"),
+                ('DELETE', "Delete", "Delete occluded objects"),
+            ),
+            default='SELECT',
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'OBJECT'
+
+    def execute(self, context):
+        if not self._check_backend():
+            return {'CANCELLED'}
+
+        obs = [o for o in context.selected_objects if o.type == 'MESH']
+        if not obs:
+            self.report({'ERROR_INVALID_INPUT'}, "No mesh objects selected")
+            return {'CANCELLED'}
+
+        start = perf_counter()
+        occluded, tricnts, viewcnt = self._find_occluded(obs)
+
+        if self.action == 'DELETE':
+            for o, occl in zip(obs, occluded):
+                if occl:
+                    bpy.data.objects.remove(o)
+        else:
+            for o in context.selected_objects:
+                o.select_set(False)
+            for o, occl in zip(obs, occluded):
+                o.select_set(occl)
+
+        self.report({'INFO'}, (
+            f"{np.count_nonzero(occluded)} of {len(obs)} objects with "
+            f"{tricnts[occluded].sum()} of {tricnts.sum()} triangles "
+            f"occluded in {viewcnt} views, {perf_counter() - start:.2f} s"
+        ))
+        return {'FINISHED'}
+
+    def _find_occluded(self, obs):
+        """
+        Return which of the given objects are not seen from any view.
+
+        Returns
+        -------
+        occluded : numpy.ndarray
+            Flag of every object, set if it is occluded. Objects without
+            triangles can't be seen, but don't count as occluded.
+        tricnts : numpy.ndarray
+            Triangle count of every object
+        viewcnt : int
+            Number of views tested
+        """
+        backend = self._get_backend()
+        verts, indcs, geoinfo = combine_meshes(obs)
+        # Render the index of the object owning each pixel, of which
+        # there are far fewer than triangles
+        vends = [v for v, _ in geoinfo]
+        vertobs = np.repeat(np.arange(len(obs)), np.diff([0] + vends))
+        # Joining or separating objects keeps the combined geometry, so
+        # the split into objects is part of the key
+        geokey = make_key(
+            verts, indcs, np.array(vends), self.dim, backend, 'OBJECT')
+        mvps = self._make_views(verts)
+        keys = [make_key(geokey, mvp) for mvp in mvps]
+
+        visibl = np.zeros(len(obs), dtype=bool)
+        viewcnt = self._test_views(
+            keys, mvps,
+            lambda m: self._render_seen(verts, indcs, m, backend, vertobs),
+            lambda m, seen: seen,
+            visibl,
+            )
+
+        tricnts = np.diff([0] + [i for _, i in geoinfo])
+        occluded = (tricnts > 0) & ~visibl
+        return occluded, tricnts, viewcnt
+
+if __name__ == "__main__":
+    register()
@@ -1,7 +1,10 @@
 import bpy
-from mathutils.kdtree import KDTree
+import numpy as np
 
 from smorgasbord.common.decorate import register
+from smorgasbord.common.io import get_scalars, get_vecs
+from smorgasbord.common.kdtree import BatchKDTree
+from smorgasbord.common.transf import transf_pts
 
 
 @register
@@ -40,16 +43,24 @@ class SelectOverlap(bpy.types.Operator):
     def _execute(self, context):
         ob = context.object
         verts = ob.data.vertices
-        kd = KDTree(len(verts))
-
-        for i, v in enumerate(verts):
-            kd.insert(ob.matrix_world @ v.co, i)
-        kd.balance()
-
-        for o in context.selected_objects:
-            if ob is o or o.type != 'MESH':
-                continue
-            for v in o.data.vertices:
-                nearest = kd.find_range(o.matrix_world @ v.co, self.dist)
-                for _, idx, _ in nearest:
-                    verts[idx].select = True
+
+        # Gather the vertices of all other selected meshes in world
+        # space
+        others = [
+            transf_pts(o.matrix_world, get_vecs(o.data.vertices))
+            for o in context.selected_objects
+            if o is not ob and o.type == 'MESH'
+            ]
+        if not others:
+            return
+
+        # A vertex in the active object is within the radius of some
+        # other vertex exactly if its closest other vertex is
+        kd = BatchKDTree(np.concatenate(others))
+        hits, _ = kd.query(
+            transf_pts(ob.matrix_world, get_vecs(verts)), self.dist)
+
+        # Add to the existing selection in one go
+        sel = get_scalars(verts)
+        sel |= hits >= 0
+        verts.foreach_set('select', sel)
@@ -1,12 +1,22 @@
 import bpy
 from math import ceil, sqrt
 import numpy as np
+from time import perf_counter
 
+from smorgasbord.common.cache import (
+    DescriptorCache,
+    make_key,
+    mesh_fingerprint,
+    sidecar_path,
+)
+from smorgasbord.common.descriptors import SAMPLED, get_descriptor
 from smorgasbord.common.io import get_bounds_and_center
-from smorgasbord.common.transf import transf_pts
+from smorgasbord.common.parallel import DescriptorPool, comp_descriptors
+from smorgasbord.common.transf import get_uniform_scale, transf_pts
 from smorgasbord.common.decorate import register
 from smorgasbord.common.draw import draw_points, View3DDrawer
-from smorgasbord.common.sample import sample_mesh, get_shape_distrib
+from smorgasbord.common.sample import get_tris, sample_tris
+from smorgasbord.common.similarity import SimilarityIndex
 # from smorgasbord.debug.plot import save_barplot
 
 
@@ -38,6 +48,21 @@ class SelectSimilar(bpy.types.Operator):
     def _update_samplecnt(self, context):
         SelectSimilar._resampl = True
 
+    mode: bpy.props.EnumProperty(
+        name="Mode",
+        description="Which objects to select",
+        items=(
+            ('RANGE', "Range",
+             "Select objects within the similarity limits"),
+            ('TOPK', "Top K",
+             "Select the given number of most similar objects"),
+            ('GROUP', "Group",
+             "Group all compared objects by similarity and select the "
+             "group of the active object"),
+        ),
+        default='RANGE',
+        update=_update_sim_limits,
+    )
     _sel_limits = (0, 1)
     sel_limits: bpy.props.FloatVectorProperty(
         name="Similarity limits",
@@ -53,6 +78,24 @@ class SelectSimilar(bpy.types.Operator):
         set=_set_sel_limits,
         update=_update_sim_limits,
     )
+    k: bpy.props.IntProperty(
+        name="K",
+        description="Number of most similar objects to select",
+        default=10,
+        min=1,
+        update=_update_sim_limits,
+    )
+    grp_thresh: bpy.props.FloatProperty(
+        name="Group Threshold",
+        description=(
+            "Objects differing less than this from the first object of "
+            "a group join the group"
+        ),
+        default=1,
+        min=0,
+        step=10,
+        update=_update_sim_limits,
+    )
     _samplcnt = 512
     samplcnt: bpy.props.IntProperty(
         name="Sample count",
@@ -72,6 +115,118 @@ class SelectSimilar(bpy.types.Operator):
         get=_get_samplecnt,
         update=_update_samplecnt,
     )
+    maxpairs: bpy.props.IntProperty(
+        name="Max Pairs",
+        description=(
+            "Estimate each shape from at most this many random pairs "
+            "of samples instead of all pairs. Bounds computation time "
+            "for high sample counts. Zero compares all pairs"
+        ),
+        default=0,
+        min=0,
+        soft_max=2**24,
+        update=_update_samplecnt,
+    )
+    seed: bpy.props.IntProperty(
+        name="Seed",
+        description=(
+            "Seed for drawing samples. The same seed yields the same "
+            "shape representation for an unchanged mesh, which allows "
+            "reusing it from the cache"
+        ),
+        default=0,
+        min=0,
+        update=_update_samplecnt,
+    )
+    d2_weight: bpy.props.FloatProperty(
+        name="Distances",
+        description=(
+            "Weight of the histogram of distances between samples, "
+            "which is the most descriptive, but slowest to compute"
+        ),
+        default=1,
+        min=0,
+        update=_update_samplecnt,
+    )
+    a3_weight: bpy.props.FloatProperty(
+        name="Angles",
+        description=(
+            "Weight of the histogram of angles between random "
+            "triplets of samples"
+        ),
+        default=0,
+        min=0,
+        update=_update_samplecnt,
+    )
+    moment_weight: bpy.props.FloatProperty(
+        name="Moments",
+        description=(
+            "Weight of the ratios between the principal moments of "
+            "the surface, which tell elongated from flat from round "
+            "shapes"
+        ),
+        default=0,
+        min=0,
+        update=_update_samplecnt,
+    )
+    box_weight: bpy.props.FloatProperty(
+        name="Box",
+        description=(
+            "Weight of the edge length ratios of the bounding box "
+            "aligned to the principal axes"
+        ),
+        default=0,
+        min=0,
+        update=_update_samplecnt,
+    )
+    compact_weight: bpy.props.FloatProperty(
+        name="Compactness",
+        description=(
+            "Weight of how close the volume to surface ratio comes to "
+            "the one of a sphere. Only meaningful for closed meshes"
+        ),
+        default=0,
+        min=0,
+        update=_update_samplecnt,
+    )
+    use_disk_cache: bpy.props.BoolProperty(
+        name="Disk Cache",
+        description=(
+            "Keep computed shape representations in a file next to "
+            "the saved .blend file, so they survive restarts"
+        ),
+        default=False,
+    )
+    procs: bpy.props.IntProperty(
+        name="Processes",
+        description=(
+            "Number of processes computing shape representations in "
+            "parallel. Zero uses one per CPU, one computes them all "
+            "in Blender's process. Doesn't change the result"
+        ),
+        default=0,
+        min=0,
+    )
+    use_modal: bpy.props.BoolProperty(
+        name="Interactive",
+        description=(
+            "When invoked from the UI, compute shape representations "
+            "in small steps between redraws, showing progress and "
+            "refining the selection on the way. Esc cancels"
+        ),
+        default=True,
+    )
+    budget: bpy.props.IntProperty(
+        name="Frame Budget",
+        description=(
+            "Milliseconds spent computing per step in interactive "
+            "mode. Higher values finish sooner, lower ones keep the "
+            "UI more responsive"
+        ),
+        default=30,
+        min=1,
+        soft_max=200,
+    )
     draw_sampls: bpy.props.BoolProperty(
         name="Draw Samples",
         description=(
@@ -81,12 +236,34 @@ class SelectSimilar(bpy.types.Operator):
     )
     # Number of bins in the shape distribution histogram
     bincnt = ceil(sqrt(_samplcnt))
-    # The shape difference of every selected object to the active one
-    # Key is the objects name, value the shape difference
-    svals = {}
+    # Descriptor kinds and the properties holding their weights
+    _weight_props = (
+        ('D2', 'd2_weight'),
+        ('A3', 'a3_weight'),
+        ('MOMENTS', 'moment_weight'),
+        ('BOX', 'box_weight'),
+        ('COMPACTNESS', 'compact_weight'),
+    )
+    # Names of the compared objects, the active one first. Sadly we
+    # can't store references to the objects directly, because those
+    # become invalid on undo, which is triggered every time this
+    # operator is re-executed with different parameters
+    _names = []
+    # Weighted descriptors of the objects in '_names'
+    _index = None
     # Switch between a mode in which samples are recalculated and one
     # in which only the selection limits can be adjusted
     _resampl = True
+    # Descriptors of meshes computed so far, shared between
+    # invocations
+    _cache = DescriptorCache()
+    # Fewer meshes to compute don't outweigh starting processes
+    _min_parallel = 64
+    # Seconds between selection updates in interactive mode
+    _sel_interval = .5
+    # Process pool computing descriptors in interactive mode, if the
+    # job is large enough
+    _pool = None
     # Stores bgl handles for drawing the sample positions
     _gl_handls = []
 
@@ -123,44 +300,160 @@ class SelectSimilar(bpy.types.Operator):
             filename=ob.name,
             )
 
-    def _get_shape_distrib(self, ob):
+    def _get_keys(self, ob, kinds, fprints):
         """
-        Sample an object's surface, draw the samples in the 3D view,
-        return the object's shape distribution, and optionally save it
-        as a plot to disk.
+        Return the keys an object's descriptors of the given kinds are
+        cached by, and whether they must be computed in world space.
+
+        All descriptors are invariant to rotation and uniform scale.
+        Instances transformed this way share descriptors computed in
+        local space; only sheared or non-uniformly scaled ones are
+        computed in world space.
+
+        Parameters
+        ----------
+        ob : bpy.types.Object
+            Mesh object to get the keys of
+        kinds : Iterable
+            Descriptor kinds, as passed to get_descriptor()
+        fprints : dict
+            Fingerprints of the meshes seen so far, to hash each
+            shared mesh only once
         """
-        points = sample_mesh(ob.data, self._samplcnt)
+        fprint = fprints.get(ob.data)
+        if fprint is None:
+            fprint = fprints[ob.data] = mesh_fingerprint(ob.data)
+        mat = ob.matrix_world
+        inwrld = get_uniform_scale(mat) is None
+        linear = np.array(mat.to_3x3()) if inwrld else None
+        sampling = (self._samplcnt, self.bincnt, self.maxpairs, self.seed)
+        keys = [
+            make_key(
+                fprint, linear, kind, *(sampling if kind in SAMPLED else ()))
+            for kind in kinds
+            ]
+        return keys, inwrld
 
-        # Draw samples
-        points = transf_pts(ob.matrix_world, points)
-        if self.draw_sampls:
-            drawer = View3DDrawer(draw_points)
-            self._gl_handls.append(drawer)
-            try:
-                drawer(tuple(points))
-            except RuntimeError as e:
-                self.report({'WARNING'}, str(e))
+    def _get_geometry(self, ob, inwrld):
+        """
+        Return the vertices and triangles of an object's mesh, the
+        vertices transformed to world space if 'inwrld' is True.
+        """
+        pts, tris = get_tris(ob.data)
+        if inwrld:
+            pts = transf_pts(ob.matrix_world, pts)
+        return pts, tris
 
-        # Calc and plot shape distribution
-        hist, bins = get_shape_distrib(points, self.bincnt)
-        # self._save_barplot(ob, bins, hist)
-        return hist
+    def _get_params(self):
+        """
+        Return the sampling parameters passed to get_descriptor().
+        """
+        return (
+            self._samplcnt,
+            self.bincnt,
+            self.maxpairs or None,
+            self.seed,
+            )
 
-    def _comp_shape_distribs(self, context):
+    def _use_pool(self, jobcnt):
+        """
+        Return whether to compute the given number of descriptors in a
+        process pool.
+        """
+        return self.procs != 1 and jobcnt >= self._min_parallel
+
+    def _get_jobs(self, todo):
+        """
+        Read the geometry of the descriptors in 'todo', a list of tuples
+        of a cache key, a descriptor kind, an object name, and whether
+        to compute the descriptor in world space. Returns the keys and
+        the (kind, pts, tris) jobs passed to get_descriptor(). Objects
+        deleted in the meantime are skipped.
+        """
+        # Read every mesh only once, even if several descriptors of it
+        # are computed
+        geoms = {}
+        keys = []
+        jobs = []
+        for key, kind, name, inwrld in todo:
+            geom = geoms.get((name, inwrld))
+            if geom is None:
+                o = bpy.data.objects.get(name)
+                if o is None:
+                    continue
+                geom = geoms[(name, inwrld)] = \
+                    self._get_geometry(o, inwrld)
+            keys.append(key)
+            jobs.append((kind, *geom))
+        return keys, jobs
+
+    def _calc_descriptors(self, todo, parallel=True):
+        """
+        Compute the descriptors in 'todo', as passed to _get_jobs().
+        Returns a dict mapping the keys to the descriptors.
+        """
+        # bpy may only be used on the main thread, so the geometry is
+        # copied out before handing it to other processes
+        keys, jobs = self._get_jobs(todo)
+        params = self._get_params()
+        if parallel and self._use_pool(len(jobs)):
+            descs = comp_descriptors(
+                jobs,
+                *params,
+                self.procs or None,
+                # Blender before 2.91 doesn't run as its own Python
+                getattr(bpy.app, 'binary_path_python', None),
+                )
+        else:
+            descs = [get_descriptor(*job, *params) for job in jobs]
+        return dict(zip(keys, descs))
+
+    def _draw_samples(self, ob):
+        """
+        Draw the samples the shape distributions of an object are
+        computed from in the 3D view.
+        """
+        pts, tris = get_tris(ob.data)
+        points = transf_pts(
+            ob.matrix_world,
+            sample_tris(pts, tris, self._samplcnt, self.seed),
+            )
+        drawer = View3DDrawer(draw_points)
+        self._gl_handls.append(drawer)
+        try:
+            drawer(tuple(points))
+        except RuntimeError as e:
+            self.report({'WARNING'}, str(e))
+
+    def _prepare(self, context):
         """
-        Compare the shape distribution of the active object to every
-        selected one. If there are none selected aside from the active
-        object, compare it against the whole active collection.
+        Find the objects to compare, the active one first, and which
+        of their descriptors are cached. If there are none selected
+        aside from the active object, compare the whole active
+        collection. Leaves the descriptors yet to compute in '_todo'.
         """
-        self.svals.clear()
         # Don't show the sampled points anymore
         self._gl_handls.clear()
-        # For handling errors if no object has mesh data
-        all_type_err = True
-        ob = context.object
-        # Get shape distribution of active object
-        adis = self._get_shape_distrib(ob)
+        self._weights = []
+        kinds = []
+        for kind, prop in self._weight_props:
+            weight = getattr(self, prop)
+            if weight > 0:
+                kinds.append(kind)
+                # Keep distance histograms in their familiar range
+                self._weights.append(weight / (self._samplcnt * 10.)
+                                     if kind == 'D2' else weight)
+        if not kinds:
+            self.report({'ERROR_INVALID_INPUT'},
+                        "At least one descriptor needs a weight")
+            return False
+
+        self._path = sidecar_path(bpy.data.filepath) \
+            if self.use_disk_cache else None
+        if self._path:
+            self._cache.load(self._path)
 
+        ob = context.object
         # Compare active with the rest of the selection if a selection
         # exists, compare all objects in the active collection if not.
         selobs = context.selected_objects
@@ -168,28 +461,122 @@ class SelectSimilar(bpy.types.Operator):
         # Blender, but is not counted in here
         if len(selobs) < 2:
             selobs = context.collection.objects
-        for o in selobs:
-            if o.type != 'MESH' or o is ob:
-                continue
-            all_type_err = False
-            odis = self._get_shape_distrib(o)
-            # Calculate similarity value to active object and store it.
-            # Sadly we can't store a reference to 'o' directly, because
-            # those references become invalid on undo, which is
-            # triggered every time this operator is re-executed with
-            # different parameters
-            self.svals[o.name] = np.linalg.norm(odis - adis, ord=1) \
-                / (self._samplcnt * 10.)
-
-        if all_type_err:
+        obs = [ob]
+        obs.extend(o for o in selobs if o.type == 'MESH' and o is not ob)
+        if len(obs) < 2:
             self.report({'ERROR_INVALID_INPUT'},
                         "Only mesh objects can be compared")
             return False
+
+        if self.draw_sampls:
+            for o in obs:
+                self._draw_samples(o)
+
+        fprints = {}
+        keys = [self._get_keys(o, kinds, fprints) for o in obs]
+        self._obnames = [o.name for o in obs]
+        self._keys = [okeys for okeys, _ in keys]
+        # Collect descriptors here instead of reading them back from
+        # the cache, which may evict some in large scenes
+        self._descs = {}
+        # Descriptors yet to be computed, once per shared mesh. Those
+        # of the active object come first.
+        todo = {}
+        for o, (okeys, inwrld) in zip(obs, keys):
+            for kind, key in zip(kinds, okeys):
+                desc = self._cache.get(key)
+                if desc is not None:
+                    self._descs[key] = desc
+                elif key not in todo:
+                    todo[key] = (key, kind, o.name, inwrld)
+        self._todo = list(todo.values())
+        self._dirty = False
+        return True
+
+    def _add_descriptors(self, todo, parallel=True):
+        """
+        Compute the descriptors in 'todo' and add them to the cache.
+        """
+        self._store(self._calc_descriptors(todo, parallel))
+
+    def _store(self, new):
+        """
+        Add a dict of computed descriptors to the cache.
+        """
+        for key, desc in new.items():
+            self._cache.put(key, desc)
+        self._descs.update(new)
+        self._dirty |= bool(new)
+
+    def _build_index(self):
+        """
+        Index the descriptors of all objects whose descriptors are
+        complete. Returns False if those of the active object aren't.
+        """
+        descs = self._descs
+        names = []
+        rows = []
+        # Weighting each descriptor before concatenating them weights
+        # its share of the L1 distance
+        for name, okeys in zip(self._obnames, self._keys):
+            if all(k in descs for k in okeys):
+                names.append(name)
+                rows.append(np.concatenate(
+                    [w * descs[k] for w, k in zip(self._weights, okeys)]))
+            elif not names:
+                return False
+        SelectSimilar._names = names
+        SelectSimilar._index = SimilarityIndex(rows)
         return True
 
+    def _save_cache(self):
+        if self._path and self._dirty:
+            try:
+                self._cache.save(self._path)
+            except OSError as e:
+                self.report({'WARNING'}, str(e))
+
+    def _comp_shape_distribs(self, context):
+        """
+        Compute or look up the descriptors of all compared objects at
+        once and index them.
+        """
+        if not self._prepare(context):
+            return False
+        self._add_descriptors(self._todo)
+        self._save_cache()
+        return self._build_index()
+
+    def _select(self):
+        """
+        Select the chosen objects, unselect all the others that we
+        calculated a similarity value for.
+        """
+        names = self._names
+        index = self._index
+        if self.mode == 'RANGE':
+            indcs, _ = index.within(index.descs[0], *self.sel_limits)
+        elif self.mode == 'TOPK':
+            indcs, _ = index.topk(index.descs[0], self.k, exclude=[0])
+        else:
+            labels = index.cluster(self.grp_thresh)
+            indcs = np.flatnonzero(labels == labels[0])
+            self.report({'INFO'}, f"{labels.max() + 1} groups found")
+
+        sel = np.zeros(len(names), dtype=bool)
+        sel[indcs] = True
+        objs = bpy.data.objects
+        # Leave the active object as it is
+        for name, s in zip(names[1:], sel[1:]):
+            o = objs.get(name)
+            if o is not None:
+                o.select_set(s)
+
     def cancel(self, context):
         # Don't show the sampled points anymore
         self._gl_handls.clear()
+        if self._pool is not None:
+            self._end_modal(context)
 
     def execute(self, context):
         # Switch between a mode in which samples are recalculated and
@@ -202,14 +589,133 @@ class SelectSimilar(bpy.types.Operator):
             # Don't show the sampled points anymore
             self._gl_handls.clear()
 
-        # Select every object within the set similarity limits,
-        # unselect all the others that we calculated a similarity value
-        # for.
-        mins, maxs = self.sel_limits
-        for name, simval in self.svals.items():
-            bpy.data.objects[name].select_set(mins <= simval < maxs)
+        self._select()
         return {'FINISHED'}
 
+    def invoke(self, context, event):
+        if not self.use_modal:
+            return self.execute(context)
+        # A new invocation always starts from fresh descriptors
+        SelectSimilar._resampl = True
+        if not self._prepare(context):
+            return {'CANCELLED'}
+        if not self._todo:
+            self._build_index()
+            self._select()
+            return {'FINISHED'}
+
+        self._total = len(self._todo)
+        if self._use_pool(self._total):
+            # Large jobs go to a process pool running in the
+            # background, whose results are collected every step
+            self._poolkeys, jobs = self._get_jobs(self._todo)
+            self._total = len(jobs)
+            self._todo = []
+            self._pool = DescriptorPool(
+                jobs,
+                *self._get_params(),
+                self.procs or None,
+                getattr(bpy.app, 'binary_path_python', None),
+                )
+        # Estimated time to compute one descriptor, refined as they
+        # arrive
+        self._itemtime = 1e-3
+        self._lastsel = perf_counter()
+        # The area to show progress in
+        self._area = context.area
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(.001, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def _collect(self):
+        """
+        Add the descriptors the process pool finished to the cache.
+        """
+        keys = self._poolkeys
+        self._store({keys[i]: desc for i, desc in self._pool.collect()})
+
+    def _left(self):
+        """
+        Return the number of descriptors yet to compute.
+        """
+        pool = self._pool
+        return len(self._todo) + (pool.left if pool is not None else 0)
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            if self._pool is not None:
+                self._collect()
+            self._end_modal(context)
+            # Earlier steps may have changed the selection already, so
+            # keep the selection from what was computed so far
+            if not self._build_index():
+                self.report({'INFO'}, "Cancelled")
+                return {'CANCELLED'}
+            self._select()
+            self.report({'INFO'}, (
+                f"Cancelled, selected from {len(self._names)} of "
+                f"{len(self._obnames)} objects"
+            ))
+            return {'FINISHED'}
+        if event.type != 'TIMER':
+            # Keep the UI usable while computing
+            return {'PASS_THROUGH'}
+
+        if self._pool is not None:
+            try:
+                self._collect()
+            except Exception as e:
+                self._end_modal(context)
+                self.report({'ERROR'}, str(e))
+                return {'CANCELLED'}
+
+        # Compute batches of descriptors until the frame budget is
+        # spent. Each batch is sized so it is expected to fit in the
+        # time left.
+        deadline = perf_counter() + self.budget * 1e-3
+        while self._todo:
+            left = deadline - perf_counter()
+            if left <= 0:
+                break
+            cnt = max(1, int(left / self._itemtime))
+            batch = self._todo[:cnt]
+            del self._todo[:cnt]
+            start = perf_counter()
+            self._add_descriptors(batch, parallel=False)
+            self._itemtime = .5 * self._itemtime \
+                + .5 * (perf_counter() - start) / len(batch)
+
+        if not self._left():
+            self._end_modal(context)
+            if not self._build_index():
+                return {'CANCELLED'}
+            self._select()
+            return {'FINISHED'}
+
+        # Refine the selection with the descriptors computed so far,
+        # but not every frame, as indexing takes time, too
+        if perf_counter() - self._lastsel > self._sel_interval \
+                and self._build_index():
+            self._select()
+            self._lastsel = perf_counter()
+
+        if self._area:
+            done = self._total - self._left()
+            self._area.header_text_set(
+                f"Select Similar: {done}/{self._total} descriptors, "
+                "Esc to cancel")
+        return {'RUNNING_MODAL'}
+
+    def _end_modal(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        if self._area:
+            self._area.header_text_set(None)
+        # Keep what was computed so far for the next run
+        self._save_cache()
 
 if __name__ == "__main__":
     register()
@@ -1,20 +1,17 @@
 import bpy
-import gpu
 import numpy as np
+from time import perf_counter
 
-from mathutils import Matrix
-from gpu_extras.batch import batch_for_shader
-
+from smorgasbord.common.cache import make_key
 from smorgasbord.common.decorate import register
 from smorgasbord.common.mesh_manip import combine_meshes
-from smorgasbord.common.sample import sample_sphere, sample_hemisphere
 from smorgasbord.common.transf import append_one
-from smorgasbord.common.io import get_bounds_and_center
-from smorgasbord.common.mat_manip import make_transf_mat, make_proj_mat
+from smorgasbord.common.io import get_scalars
+from smorgasbord.common.visibility import ViewTester
 
 
 @register
-class SelectVisible(bpy.types.Operator):
+class SelectVisible(ViewTester, bpy.types.Operator):
     bl_idname = "mesh.select_visible"
     bl_label = "Select Visible"
     bl_description = (
@@ -25,52 +22,48 @@ class SelectVisible(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
     menus = [bpy.types.VIEW3D_MT_select_edit_mesh]
 
-    samplecnt: bpy.props.IntProperty(
-            name="Sample Count",
-            description=(
-                "Number of times the objects are rendered from "
-                "different angles. Lower values decrease calculation "
-                "time, but increase the change that visible vertices "
-                "are missed"
-            ),
-            default=16,
-    )
-    dim: bpy.props.IntProperty(
-            name="Resolution",
+    tolerance: bpy.props.FloatProperty(
+            name="Tolerance",
             description=(
-                "Pixel count of the rendered images along one axis. "
-                "Lower values decrease calculation time, but increase "
-                "the change that a vertex is declared occluded when it "
-                "barely peeks out behind an occluder"
+                "Depth a vertex may lie behind the rendered surface "
+                "and still count as visible. Prevents surfaces from "
+                "occluding their own vertices"
             ),
-            default=128,
+            default=.001,
+            min=0,
+            step=.01,
+            precision=4,
     )
-    dom: bpy.props.EnumProperty(
-            name="Domain",
-            description=(
-                "On which surface to sample the render positions. The "
-                "radius is chosen adaptively from the bounds of the "
-                "objects"
-            ),
+    elem: bpy.props.EnumProperty(
+            name="Test",
+            description="Which elements to test for visibility",
             items=(
-                ('SPHERE', "Sphere", "Also render from the bottom"),
-                ('HEMI', "Hemisphere", "Render only from above"),
-            )
+                ('VERT', "Vertices",
+                 "Select vertices whose depth matches the rendered "
+                 "depth at their pixel"),
+                ('FACE', "Faces",
+                 "Select faces seen in any pixel of a render, and "
+                 "their vertices. Doesn't need a tolerance and is "
+                 "independent of the vertex count"),
+            ),
+            default='VERT',
     )
     _debug_create_img = False
-    _debug_spawn_cams = False
-    _debug_spawn_sphere = False
 
     @classmethod
     def poll(cls, context):
         return context.mode == 'EDIT_MESH'
 
     def execute(self, context):
+        if not self._check_backend():
+            return {'CANCELLED'}
+
         obs = context.objects_in_mode
+        start = perf_counter()
         # Mesh can't be updated in edit mode
         bpy.ops.object.mode_set(mode='OBJECT')
         try:
-            self._execute_inner(obs)
+            viewcnt = self._execute_inner(obs)
         finally:
             if not (self._debug_spawn_cams or self._debug_spawn_sphere):
                 bpy.ops.object.mode_set(mode='EDIT')
@@ -78,161 +71,141 @@ class SelectVisible(bpy.types.Operator):
         # because only vertices are updated, ensure selection is also
         # seen in edge and face mode
         sel_mode = context.tool_settings.mesh_select_mode
-        if sel_mode[1] or sel_mode[2]:
+        if self.elem == 'VERT' and (sel_mode[1] or sel_mode[2]):
             bpy.ops.mesh.select_mode(use_extend=True, type='VERT')
             bpy.ops.mesh.select_mode(use_extend=True, type='VERT')
 
+        self.report({'INFO'}, f"Tested {viewcnt} of {self.samplecnt} views "
+                    f"in {perf_counter() - start:.2f} s")
         return {'FINISHED'}
 
-    def _execute_inner(self, obs):
+    def _test_verts(self, hverts, mvps, depths):
+        """
+        Return a V x N mask of the vertices seen in each of V depth
+        buffers rendered with the given Model View Projection matrices.
+        All views are projected at once.
+        """
         dim = self.dim
         dimhalf = dim * .5
-        offbuf = gpu.types.GPUOffScreen(dim, dim)
-        sample = sample_sphere if self.dom == 'SPHERE' \
-            else sample_hemisphere
-
-        # Construct depthpass shader
-        shader = gpu.types.GPUShader(
-            vertexcode='''
-            uniform mat4 mvp;
-            in vec3 pos;
-            void main() {
-                gl_Position = mvp * vec4(pos, 1);
-            }''',
-            fragcode='''
-            out vec4 col;
-            void main() {
-                col = vec4(0, 0, 1, 1);
-            }'''
-        )
-        shader.bind()
-
-        # Create batch from all objects in edit mode
+        # Transform verts of active object to clip space of every view
+        tverts = np.asarray(mvps) @ hverts
+        # Perspective divide to transform to NDCs [-1, 1]
+        tverts /= tverts[:, 3:]
+
+        # Find pixel coordinates of each vertex' projected position
+        # by remapping x and y coordinates from NDCs to [0, dim]
+        # Add .5 to make sure the flooring from conversion to int
+        # is actually rounding
+        uvs = tverts[:, :2] * dimhalf + (dimhalf + .5)
+        uvs = uvs.astype(np.int32)
+
+        # Map all vertices outside the view frustum to (0, 0)
+        # so they don't sample the pixel array out of bounds
+        invalid = np.any((uvs < 0) | (dim <= uvs), axis=1)
+        uvs *= ~invalid[:, np.newaxis]
+
+        # For each vertex, get the depth at its projected pixel
+        # and its distance to the render position
+        views = np.arange(len(depths))[:, np.newaxis]
+        imgdpth = np.asarray(depths)[views, uvs[:, 1], uvs[:, 0]]
+        camdist = tverts[:, 2]
+        # Set the distance of invalid vertices past [-1, 1] so they
+        # won't be selected
+        camdist[invalid] = 2
+
+        # Create debug image of the last rendered view
+        if self._debug_create_img:
+            # Grayscale to RGBA and [-1, 1] to [0, 1]
+            pxbuf = np.repeat(depths[-1], 4) * .5 + .5
+            pxbuf.shape = (dim, dim, 4)
+            # Alpha channel is 1
+            pxbuf[:, :, 3] = 1
+            # Mark projected vertex positions in red
+            pxbuf[(uvs[-1, 1], uvs[-1, 0])] = (1, 0, 0, 1)
+
+            imgname = "Debug"
+            if imgname not in bpy.data.images:
+                bpy.data.images.new(imgname, dim, dim)
+            image = bpy.data.images[imgname]
+            image.scale(dim, dim)
+            image.pixels = pxbuf.ravel()
+
+        # A vertex is visible if it's inside the view frustum
+        # (valid) and not occluded by any face.
+        # A vertex is occluded when its depth sampled from the
+        # image is smaller than its distance to the camera.
+        # A small error margin is added to prevent self-occlusion.
+        return camdist <= (imgdpth + self.tolerance)
+
+    def _select_faces(self, obs, indcs, geoinfo, visibl):
+        """
+        Select the faces owning a visible triangle, and their edges and
+        vertices, deselecting everything else.
+        """
+        # Split visible flag list back in original objects, deriving
+        # the flags of faces, edges and vertices from the triangles'
+        vstart = istart = 0
+        for o, (vend, iend) in zip(obs, geoinfo):
+            mesh = o.data
+            tris = visibl[istart:iend]
+            polyindcs = get_scalars(
+                mesh.loop_triangles, 'polygon_index', np.int32)
+            polys = np.zeros(len(mesh.polygons), dtype=bool)
+            polys[polyindcs[tris]] = True
+
+            verts = np.zeros(vend - vstart, dtype=bool)
+            verts[indcs[istart:iend][tris].ravel() - vstart] = True
+
+            loops = np.repeat(polys, get_scalars(
+                mesh.polygons, 'loop_total', np.int32))
+            edges = np.zeros(len(mesh.edges), dtype=bool)
+            edges[get_scalars(mesh.loops, 'edge_index', np.int32)[loops]] \
+                = True
+
+            mesh.vertices.foreach_set('select', verts)
+            mesh.edges.foreach_set('select', edges)
+            mesh.polygons.foreach_set('select', polys)
+            vstart = vend
+            istart = iend
+
+    def _execute_inner(self, obs):
+        """
+        Select the visible elements of the given objects and return the
+        number of views tested.
+        """
+        backend = self._get_backend()
         verts, indcs, geoinfo = combine_meshes(obs)
-        batch = batch_for_shader(
-            shader, 'TRIS',
-            {"pos": verts},
-            indices=indcs,
-        )
-        batch.program_set(shader)
-
-        # Find the center and bounds of all objects to calculate the
-        # encompassing radius of the (hemi-)sphere on which render
-        # positions will be sampled
-        bounds, centr = get_bounds_and_center(verts)
-        rad = np.linalg.norm(bounds[:2]) * .5 + 1
-        del indcs, bounds
-
-        # Spawn debug sphere with calculated radius
-        if self._debug_spawn_sphere:
-            bpy.ops.mesh.primitive_uv_sphere_add(
-                radius=rad,
-                location=centr,
+        # Renders can be reused as long as the geometry stays the same
+        geokey = make_key(verts, indcs, self.dim, backend, self.elem)
+
+        mvps = self._make_views(verts)
+        keys = [make_key(geokey, mvp) for mvp in mvps]
+
+        if self.elem == 'FACE':
+            # Mark triangles seen from any view
+            visibl = np.zeros(len(indcs), dtype=bool)
+            viewcnt = self._test_views(
+                keys, mvps,
+                lambda m: self._render_seen(verts, indcs, m, backend),
+                lambda m, seen: seen,
+                visibl,
                 )
+            self._select_faces(obs, indcs, geoinfo, visibl)
+            return viewcnt
 
-        # Render the objects from several views and mark seen vertices
+        # Mark vertices seen from any view
         visibl = np.zeros(len(verts), dtype=bool)
-        for _ in range(self.samplecnt):
-            # Generate random points on the chosen domain from which
-            # to render the objects
-            # Chose rotation so the 'camera' looks to the center
-            samplepos, (theta, phi) = sample(rad)
-            view_mat_inv = make_transf_mat(
-                transl=samplepos + centr,
-                rot=(phi, 0, theta + np.pi * .5),
-                )
-
-            # Spawn debug camera at sampled position
-            if self._debug_spawn_cams:
-                bpy.ops.object.camera_add()
-                bpy.context.object.matrix_world = Matrix(view_mat_inv)
-
-            # Build the Model View Projection matrix from chosen
-            # render position and radius
-            # The model matrix has already been applied to the vertices
-            # befor creating the batch
-            mvp = make_proj_mat(
-                fov=90,
-                clip_start=rad * .25,
-                clip_end=rad * 1.5,
-                dimx=dim,
-                dimy=dim,
-                ) @ np.linalg.inv(view_mat_inv)
-            shader.uniform_float("mvp", Matrix(mvp))
-            del view_mat_inv, samplepos, theta, phi
-
-            with offbuf.bind():
-                # Render the selected objects into the offscreen buffer
-                framebuffer = gpu.state.active_framebuffer_get()
-                gpu.state.depth_mask_set(True)
-                framebuffer.clear(depth=1.0)
-                gpu.state.depth_test_set('LESS')
-                batch.draw()
-
-                # Write texture back to CPU
-                pxbuf = framebuffer.read_depth(0, 0, dim, dim)
-                # Have to reset the state to not hit https://projects.blender.org/blender/blender/issues/98486
-                gpu.state.depth_mask_set(False)
-                gpu.state.depth_test_set('NONE')
-
-            # Map depth values from [0, 1] to [-1, 1]
-            pxbuf = np.array(pxbuf.to_list()) * 2 - 1
-            pxbuf.shape = (dim, dim)
-
-            # Transform verts of active object to clip space
-            tverts = mvp @ append_one(verts).T
-            # Perspective divide to transform to NDCs [-1, 1]
-            tverts /= tverts[3]
-
-            # Find pixel coordinates of each vertex' projected position
-            # by remapping x and y coordinates from NDCs to [0, dim]
-            # Add .5 to make sure the flooring from conversion to int
-            # is actually rounding
-            uvs = tverts[:2] * dimhalf + (dimhalf + .5)
-            uvs = uvs.astype(np.int32)
-
-            # Map all vertices outside the view frustum to (0, 0)
-            # so they don't sample the pixel array out of bounds
-            invalid = np.any((uvs < 0) | (dim <= uvs), axis=0)
-            uvs.T[invalid] = (0, 0)
-
-            # For each vertex, get the depth at its projected pixel
-            # and its distance to the render position
-            imgdpth = pxbuf[(uvs[1], uvs[0])]
-            camdist = tverts[2]
-            # Set the distance of invalid vertices past [-1, 1] so they
-            # won't be selected
-            camdist[invalid] = 2
-
-            # A vertex is visible if it's inside the view frustum
-            # (valid) and not occluded by any face.
-            # A vertex is occluded when its depth sampled from the
-            # image is smaller than its distance to the camera.
-            # A small error margin is added to prevent self-occlusion.
-            # The result is logically or-ed with the result from other
-            # render positions.
-            visibl |= camdist <= (imgdpth + .001)
-
-            # Create debug image of the rendered view
-            if self._debug_create_img:
-                # Grayscale to RGBA and [-1, 1] to [0, 1]
-                pxbuf = np.repeat(pxbuf, 4) * .5 + .5
-                pxbuf.shape = (dim, dim, 4)
-                # Alpha channel is 1
-                pxbuf[:, :, 3] = 1
-                # Mark projected vertex positions in red
-                pxbuf[(uvs[1], uvs[0])] = (1, 0, 0, 1)
-
-                imgname = "Debug"
-                if imgname not in bpy.data.images:
-                    bpy.data.images.new(imgname, dim, dim)
-                image = bpy.data.images[imgname]
-                image.scale(dim, dim)
-                image.pixels = pxbuf.ravel()
+        hverts = append_one(verts).T
+        viewcnt = self._test_views(
+            keys, mvps,
+            lambda m: self._render_views(verts, indcs, m, backend),
+            lambda m, depths: self._test_verts(hverts, m, depths),
+            visibl,
+            )
 
         # Split visible flag list back in original objects
-        offbuf.free()
         start = 0
         for o, (end, _) in zip(obs, geoinfo):
             o.data.vertices.foreach_set('select', visibl[start:end])
             start = end
+        return viewcnt